@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# ytdlbot - bench_pipeline.py
+# offline end to end benchmark of the download, convert and upload pipeline
+# sample media is generated with ffmpeg and served from a local http server, uploads go to a fake client
+# usage: cd ytdlbot && python ../scripts/bench_pipeline.py -c 1,4,8 -o bench.json [--compare old.json] 2>/dev/null
+
+import argparse
+import concurrent.futures
+import functools
+import http.server
+import json
+import logging
+import os
+import pathlib
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import psutil
+
+WORKDIR = pathlib.Path(tempfile.gettempdir(), "ytdl-bench")
+# every temp file and the trace file of the bot go here, so disk use and stages can be measured
+os.environ["TMPFILE"] = WORKDIR.joinpath("tmp").as_posix()
+os.environ["TRACE_FILE"] = WORKDIR.joinpath("trace.jsonl").as_posix()
+# webm and flv samples go through the conversion to mp4 unless it's disabled explicitly
+os.environ.setdefault("ENABLE_FFMPEG", "1")
+
+sys.path.insert(0, pathlib.Path(__file__).parent.parent.joinpath("ytdlbot").as_posix())
+
+import tasks  # noqa: E402
+from fake_client import FakeClient, FakeMessage  # noqa: E402
+from tracing import percentile, read_traces  # noqa: E402
+
+# name -> ffmpeg output arguments, all of them get a test pattern and a sine wave
+SAMPLES = {
+    "mp4": ["-c:v", "libx264", "-preset", "veryfast", "-c:a", "aac", "-movflags", "+faststart"],
+    "webm": ["-c:v", "libvpx-vp9", "-deadline", "realtime", "-cpu-used", "8", "-c:a", "libopus"],
+    "flv": ["-c:v", "flv", "-c:a", "libmp3lame"],
+}
+SAMPLE_SECONDS = 10
+# lossless, so it gets big fast without spending much time in the encoder
+LARGE_ARGS = ["-c:v", "libx264", "-preset", "ultrafast", "-qp", "0", "-c:a", "aac"]
+PIPELINES = ["ytdl", "direct"]
+
+
+def generate_samples(directory: pathlib.Path, large_mb: int) -> dict:
+    directory.mkdir(parents=True, exist_ok=True)
+    source = ["-f", "lavfi", "-i", "testsrc2=size=1280x720:rate=30", "-f", "lavfi", "-i", "sine=frequency=440"]
+    jobs = {f"sample.{ext}": args + ["-t", str(SAMPLE_SECONDS)] for ext, args in SAMPLES.items()}
+    if large_mb:
+        # roughly 30MB per second of lossless 720p test pattern
+        jobs[f"large-{large_mb}m.mp4"] = LARGE_ARGS + ["-t", str(max(1, large_mb // 30))]
+
+    for name, args in jobs.items():
+        path = directory.joinpath(name)
+        if not path.exists():
+            print(f"generating {name}")
+            subprocess.check_call(
+                ["ffmpeg", "-v", "error", "-y", *source, *args, path.with_suffix(".part" + path.suffix)]
+            )
+            path.with_suffix(".part" + path.suffix).rename(path)
+    return {name: directory.joinpath(name).stat().st_size for name in jobs}
+
+
+def serve(directory: pathlib.Path) -> str:
+    handler = functools.partial(QuietHandler, directory=directory.as_posix())
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class Sampler:
+    # peak rss of this process and its ffmpeg children, and peak size of the temp directory
+    def __init__(self, tmp: pathlib.Path, interval: float = 0.05):
+        self.tmp = tmp
+        self.interval = interval
+        self.peak_rss = 0
+        self.peak_tmp = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        proc = psutil.Process()
+        while not self.stopped.is_set():
+            rss = proc.memory_info().rss
+            for child in proc.children(recursive=True):
+                try:
+                    rss += child.memory_info().rss
+                except psutil.Error:
+                    pass
+            self.peak_rss = max(self.peak_rss, rss)
+            self.peak_tmp = max(self.peak_tmp, dir_size(self.tmp))
+            self.stopped.wait(self.interval)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stopped.set()
+        self.thread.join()
+
+
+def dir_size(path: pathlib.Path) -> int:
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.stat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return size
+
+
+def run_level(pipeline: str, concurrency: int, urls: list, rounds: int) -> dict:
+    # unlimited bandwidth and no telegram limits, only the pipeline itself is measured
+    client = FakeClient(rate_limit=0, chat_rate_limit=0)
+    func = tasks.ytdl_normal_download if pipeline == "ytdl" else tasks.direct_normal_download
+    jobs = list(range(concurrency * rounds))
+    errors = []
+
+    def job(n):
+        # a query string per job, so neither the info cache nor the send cache can skip the work
+        url = f"{urls[n % len(urls)]}?bench={pipeline}-{concurrency}-{n}-{time.time()}"
+        try:
+            func(client, FakeMessage(client, 10000 + n, n + 1), url)
+        except Exception as e:
+            errors.append(repr(e))
+
+    start = time.time()
+    with Sampler(pathlib.Path(os.environ["TMPFILE"])) as sampler:
+        with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+            list(executor.map(job, jobs))
+    wall = time.time() - start
+
+    stages = {}
+    for trace in read_traces(start):
+        if trace["task"] != pipeline:
+            continue
+        stages.setdefault("total", []).append(trace["seconds"])
+        for s in trace["spans"]:
+            stages.setdefault(s["stage"], []).append(s["seconds"])
+    return {
+        "pipeline": pipeline,
+        "concurrency": concurrency,
+        "tasks": len(jobs),
+        "errors": len(errors),
+        "error_samples": errors[:3],
+        "wall": round(wall, 3),
+        "tasks_per_s": round(len(jobs) / wall, 3),
+        "mb_per_s": round(client.stats["uploaded_bytes"] / 1024**2 / wall, 3),
+        "peak_rss_mb": round(sampler.peak_rss / 1024**2, 1),
+        "peak_tmp_mb": round(sampler.peak_tmp / 1024**2, 1),
+        "stages": {
+            stage: {
+                "count": len(values),
+                "mean": round(sum(values) / len(values), 3),
+                "p50": percentile(values, 0.5),
+                "p95": percentile(values, 0.95),
+            }
+            for stage, values in sorted(stages.items())
+        },
+    }
+
+
+def revision() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def print_result(r: dict, old: dict = None):
+    line = (
+        f"{r['pipeline']:<7}c={r['concurrency']:<4}{r['tasks']:>4} tasks {r['errors']:>2} errors "
+        f"{r['wall']:>8.2f}s {r['tasks_per_s']:>7.2f} tasks/s {r['mb_per_s']:>8.1f} MB/s "
+        f"rss {r['peak_rss_mb']:>7.1f}MB tmp {r['peak_tmp_mb']:>7.1f}MB"
+    )
+    if old:
+        line += f"  ({r['mb_per_s'] / old['mb_per_s']:.2f}x throughput vs {old['revision']})"
+    print(line)
+    for stage, s in r["stages"].items():
+        print(f"    {stage:<10}{s['count']:>5} p50 {s['p50']:>7.3f}s p95 {s['p95']:>7.3f}s mean {s['mean']:>7.3f}s")
+    for e in r["error_samples"]:
+        print(f"    error: {e}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--concurrency", default="1,4,8", help="comma separated concurrency levels")
+    parser.add_argument("-r", "--rounds", type=int, default=2, help="tasks per worker thread at each level")
+    parser.add_argument("-p", "--pipeline", default=",".join(PIPELINES), help="comma separated: ytdl,direct")
+    parser.add_argument("--large", type=int, default=200, help="size of the large sample in MB, 0 to skip it")
+    parser.add_argument("-o", "--output", help="write the results to this json file")
+    parser.add_argument("--compare", help="json file of a previous run, throughput is shown relative to it")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    shutil.rmtree(os.environ["TMPFILE"], ignore_errors=True)
+    pathlib.Path(os.environ["TMPFILE"]).mkdir(parents=True)
+    sizes = generate_samples(WORKDIR.joinpath("samples"), args.large)
+    base = serve(WORKDIR.joinpath("samples"))
+    urls = [f"{base}/{name}" for name in sizes]
+
+    previous = {}
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        for r in old["results"]:
+            previous[(r["pipeline"], r["concurrency"])] = dict(r, revision=old["revision"])
+
+    results = []
+    for pipeline in args.pipeline.split(","):
+        for concurrency in map(int, args.concurrency.split(",")):
+            r = run_level(pipeline, concurrency, urls, args.rounds)
+            print_result(r, previous.get((pipeline, concurrency)))
+            results.append(r)
+
+    if args.output:
+        report = {
+            "revision": revision(),
+            "time": time.time(),
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+            "samples": sizes,
+            "results": results,
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# ytdlbot - bench_progress.py
+# compare the progress text rendering against the old per-hook tqdm instantiation
+# usage: cd ytdlbot && python ../scripts/bench_progress.py
+
+import functools
+import pathlib
+import sys
+import timeit
+from io import StringIO
+
+from tqdm import tqdm
+
+sys.path.insert(0, pathlib.Path(__file__).parent.parent.joinpath("ytdlbot").as_posix())
+
+from downloader import tqdm_progress  # noqa: E402
+
+NUMBER = 20000
+# debounce lets roughly one edit through for every this many progress callbacks
+HOOK_CALLS_PER_EDIT = 50
+
+
+def tqdm_instance_progress(desc, total, finished, speed="", eta=""):
+    # the previous implementation, kept here as the baseline
+    def more(title, initial):
+        if initial:
+            return f"{title} {initial}"
+        else:
+            return ""
+
+    f = StringIO()
+    tqdm(
+        total=total,
+        initial=finished,
+        file=f,
+        ascii=False,
+        unit_scale=True,
+        ncols=30,
+        bar_format="{l_bar}{bar} |{n_fmt}/{total_fmt} ",
+    )
+    raw_output = f.getvalue()
+    tqdm_output = raw_output.split("|")
+    progress = f"`[{tqdm_output[1]}]`"
+    detail = tqdm_output[2].replace("[A", "")
+    text = f"""
+{desc}
+
+{progress}
+{detail}
+{more("Speed:", speed)}
+{more("ETA:", eta)}
+    """
+    f.close()
+    return text
+
+
+def hook_eager(i):
+    # old hooks: render on every callback, then debounce drops most of them
+    text = tqdm_instance_progress("Downloading...", 1024**3, i * 1024, "1.0MiB/s", "00:10")
+    if i % HOOK_CALLS_PER_EDIT == 0:
+        return text
+
+
+def hook_lazy(i):
+    # new hooks: pass a partial, only the edits that are sent get rendered
+    text = functools.partial(tqdm_progress, "Downloading...", 1024**3, i * 1024, "1.0MiB/s", "00:10")
+    if i % HOOK_CALLS_PER_EDIT == 0:
+        return text()
+
+
+def bench(name, func):
+    counter = iter(range(NUMBER * 2))
+    elapsed = timeit.timeit(lambda: func(next(counter)), number=NUMBER)
+    print(f"{name:<28}{elapsed / NUMBER * 1e6:>10.2f} us/call")
+    return elapsed
+
+
+def main():
+    samples = [(100, 5), (0, 0), (1000, 0), (5 * 1024**3, 1234567), (300000, 299999), (None, 10)]
+    for total, finished in samples:
+        expected = tqdm_instance_progress("Downloading...", total, finished, "1MiB/s", "00:10")
+        actual = tqdm_progress("Downloading...", total, finished, "1MiB/s", "00:10")
+        assert expected == actual, f"output mismatch for {total}, {finished}: {expected!r} != {actual!r}"
+
+    render = (1024**3, 1024 * 1024, "1.0MiB/s", "00:10")
+    old = bench("tqdm instance render", lambda _: tqdm_instance_progress("Downloading...", *render))
+    new = bench("format_meter render", lambda _: tqdm_progress("Downloading...", *render))
+    print(f"render speedup: {old / new:.1f}x\n")
+
+    old = bench("hook, eager render", hook_eager)
+    new = bench("hook, lazy render", hook_lazy)
+    print(f"hook speedup: {old / new:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# ytdlbot - fake_client.py
+# local stand-in for pyrogram.Client, for benchmarks and load tests of the telegram facing paths
+
+import collections
+import contextlib
+import itertools
+import math
+import os
+import pathlib
+import random
+import threading
+import time
+import types
+
+import pyrogram.errors
+from pyrogram import enums, raw
+from pyrogram import types as pyro_types
+from pyrogram.file_id import FileId, FileType, ThumbnailSource
+
+FILE_TYPES = {
+    "video": FileType.VIDEO,
+    "document": FileType.DOCUMENT,
+    "audio": FileType.AUDIO,
+    "animation": FileType.ANIMATION,
+    "photo": FileType.PHOTO,
+}
+MEDIA_KINDS = {
+    pyro_types.InputMediaVideo: "video",
+    pyro_types.InputMediaPhoto: "photo",
+    pyro_types.InputMediaAudio: "audio",
+    pyro_types.InputMediaAnimation: "animation",
+}
+
+
+def make_file_id(kind: str, media_id: int) -> str:
+    if kind == "photo":
+        file_id = FileId(
+            file_type=FileType.PHOTO,
+            dc_id=2,
+            media_id=media_id,
+            access_hash=media_id,
+            thumbnail_source=ThumbnailSource.THUMBNAIL,
+            thumbnail_file_type=FileType.PHOTO,
+            thumbnail_size="y",
+            volume_id=0,
+            local_id=0,
+        )
+    else:
+        file_id = FileId(file_type=FILE_TYPES[kind], dc_id=2, media_id=media_id, access_hash=media_id)
+    return file_id.encode()
+
+
+class FakeMessage:
+    def __init__(self, client, chat_id: int, message_id: int, text: str = None, **kwargs):
+        self._client = client
+        self.id = message_id
+        self.chat = types.SimpleNamespace(
+            id=chat_id, type=enums.ChatType.PRIVATE, username=f"user{chat_id}", first_name="Fake", last_name=""
+        )
+        self.from_user = types.SimpleNamespace(id=chat_id, username=self.chat.username, first_name="Fake")
+        self.text = text
+        self.caption = kwargs.pop("caption", None)
+        self.reply_markup = kwargs.pop("reply_markup", None)
+        self.document = self.video = self.audio = self.animation = self.photo = None
+        self.date = time.time()
+
+    def edit_text(self, text: str, **kwargs):
+        return self._client.edit_message_text(self.chat.id, self.id, text, **kwargs)
+
+    def edit_caption(self, caption: str, **kwargs):
+        return self._client.edit_message_caption(self.chat.id, self.id, caption, **kwargs)
+
+    def reply_text(self, text: str, quote: bool = None, **kwargs):
+        return self._client.send_message(self.chat.id, text, **kwargs)
+
+    def reply_document(self, document, quote: bool = None, **kwargs):
+        return self._client.send_document(self.chat.id, document, **kwargs)
+
+
+class FakeClient:
+    """
+    Behaves like a bot client for the methods ytdlbot uses, without any network.
+
+    bandwidth: bytes per second of the shared uplink, None for unlimited. Every upload takes its parts from it in turn.
+    latency: seconds each API call takes.
+    flood_rate: chance that an API call fails with FloodWait of flood_seconds.
+    rate_limit, chat_rate_limit: messages (sent or edited) per second for the whole bot and for each chat,
+    more than that is answered with FloodWait, and every call fails until the wait is over, as Telegram does.
+    """
+
+    part_size = 512 * 1024
+
+    def __init__(
+        self,
+        bandwidth: float = None,
+        latency: float = 0,
+        flood_rate: float = 0,
+        flood_seconds: int = 5,
+        rate_limit: int = 30,
+        chat_rate_limit: int = 20,
+        max_concurrent_transmissions: int = 4,
+        seed: int = None,
+    ):
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.flood_seconds = flood_seconds
+        self.rate_limit = rate_limit
+        self.chat_rate_limit = chat_rate_limit
+        self.max_concurrent_transmissions = max_concurrent_transmissions
+        self.random = random.Random(seed)
+
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        # (chat_id, message_id) -> FakeMessage
+        self.messages = {}
+        # None for the whole bot, or chat_id -> recent message timestamps
+        self.sent = collections.defaultdict(collections.deque)
+        self.flooded_until = 0
+        self.transmissions = threading.Semaphore(max_concurrent_transmissions)
+        self.next_slot = 0
+
+        self.stats = collections.Counter()
+        self.uploading = 0
+
+    def _call(self, method: str, chat_id: int = None, message: bool = False):
+        # every API call goes through here: count it, wait for the latency and maybe fail with FloodWait
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.stats[method] += 1
+            now = time.time()
+            if now < self.flooded_until:
+                self._flood(math.ceil(self.flooded_until - now))
+            if self.flood_rate and self.random.random() < self.flood_rate:
+                self.flooded_until = now + self.flood_seconds
+                self._flood(self.flood_seconds)
+            if message:
+                self._check_rate(None, self.rate_limit, now)
+                self._check_rate(chat_id, self.chat_rate_limit, now)
+                self.sent[None].append(now)
+                self.sent[chat_id].append(now)
+
+    def _check_rate(self, key, limit: int, now: float):
+        if not limit:
+            return
+        window = self.sent[key]
+        while window and now - window[0] >= 1:
+            window.popleft()
+        if len(window) >= limit:
+            self.flooded_until = max(self.flooded_until, window[0] + 1)
+            self._flood(math.ceil(self.flooded_until - now))
+
+    def _flood(self, seconds: int):
+        self.stats["flood_wait"] += 1
+        raise pyrogram.errors.FloodWait(value=seconds)
+
+    def _transfer(self, size: int):
+        # the uplink is shared, each part waits for its slot like the edit budget in EditDispatcher
+        if not self.bandwidth:
+            return
+        with self.lock:
+            now = time.time()
+            self.next_slot = max(now, self.next_slot) + size / self.bandwidth
+            wait = self.next_slot - now
+        time.sleep(wait)
+
+    def _upload(self, file, progress=None, progress_args=()) -> int:
+        if hasattr(file, "read"):
+            file.seek(0, os.SEEK_END)
+            total = file.tell()
+            file.seek(0)
+            # the caller's file object stays open, as with pyrogram
+            f = contextlib.nullcontext(file)
+        else:
+            total = os.stat(file).st_size
+            f = open(file, "rb")
+
+        current = 0
+        with self.transmissions, f as fp:
+            with self.lock:
+                self.uploading += 1
+                self.stats["peak_uploads"] = max(self.stats["peak_uploads"], self.uploading)
+            try:
+                # the same part size and progress calls as pyrogram's save_file
+                while chunk := fp.read(self.part_size):
+                    self._transfer(len(chunk))
+                    current += len(chunk)
+                    if progress:
+                        progress(current, total, *progress_args)
+            finally:
+                with self.lock:
+                    self.uploading -= 1
+                    self.stats["uploaded_bytes"] += current
+        return total
+
+    def _new_message(self, chat_id: int, text: str = None, **kwargs) -> FakeMessage:
+        msg = FakeMessage(self, chat_id, next(self.ids), text, **kwargs)
+        self.messages[(chat_id, msg.id)] = msg
+        return msg
+
+    def _send_media(self, method: str, kind: str, chat_id: int, file, progress, progress_args, **kwargs):
+        self._call(method, chat_id, message=True)
+        if isinstance(file, str) and not os.path.exists(file):
+            # a file id, nothing to upload
+            file_id = file
+        else:
+            self._upload(file, progress, progress_args)
+            file_id = make_file_id(kind, next(self.ids))
+        kwargs.pop("force_document", None)
+        msg = self._new_message(chat_id, caption=kwargs.get("caption"), reply_markup=kwargs.get("reply_markup"))
+        setattr(msg, kind, types.SimpleNamespace(file_id=file_id, file_name=getattr(file, "name", str(file))))
+        return msg
+
+    def incoming(self, chat_id: int, text: str) -> FakeMessage:
+        # a message from a user, as the handlers get it
+        return self._new_message(chat_id, text)
+
+    def send_message(self, chat_id: int, text: str, **kwargs):
+        self._call("send_message", chat_id, message=True)
+        return self._new_message(chat_id, text, reply_markup=kwargs.get("reply_markup"))
+
+    def edit_message_text(self, chat_id: int, message_id: int, text: str, **kwargs):
+        self._call("edit_message_text", chat_id, message=True)
+        msg = self.messages.get((chat_id, message_id)) or self._new_message(chat_id)
+        if msg.text == text:
+            raise pyrogram.errors.MessageNotModified()
+        msg.text = text
+        return msg
+
+    def edit_message_caption(self, chat_id: int, message_id: int, caption: str, **kwargs):
+        self._call("edit_message_caption", chat_id, message=True)
+        msg = self.messages.get((chat_id, message_id)) or self._new_message(chat_id)
+        msg.caption = caption
+        return msg
+
+    def send_video(self, chat_id: int, video, progress=None, progress_args=(), **kwargs):
+        return self._send_media("send_video", "video", chat_id, video, progress, progress_args, **kwargs)
+
+    def send_document(self, chat_id: int, document, progress=None, progress_args=(), **kwargs):
+        return self._send_media("send_document", "document", chat_id, document, progress, progress_args, **kwargs)
+
+    def send_audio(self, chat_id: int, audio, progress=None, progress_args=(), **kwargs):
+        return self._send_media("send_audio", "audio", chat_id, audio, progress, progress_args, **kwargs)
+
+    def send_animation(self, chat_id: int, animation, progress=None, progress_args=(), **kwargs):
+        return self._send_media("send_animation", "animation", chat_id, animation, progress, progress_args, **kwargs)
+
+    def send_photo(self, chat_id: int, photo, progress=None, progress_args=(), **kwargs):
+        return self._send_media("send_photo", "photo", chat_id, photo, progress, progress_args, **kwargs)
+
+    def send_media_group(self, chat_id: int, media: list, **kwargs):
+        if not 2 <= len(media) <= 10:
+            raise pyrogram.errors.MediaInvalid()
+        self._call("send_media_group", chat_id, message=True)
+        res = []
+        for item in media:
+            kind = MEDIA_KINDS.get(type(item), "document")
+            if isinstance(item.media, str) and not os.path.exists(item.media):
+                file_id = item.media
+            else:
+                self._upload(item.media)
+                file_id = make_file_id(kind, next(self.ids))
+            msg = self._new_message(chat_id, caption=item.caption)
+            setattr(msg, kind, types.SimpleNamespace(file_id=file_id))
+            res.append(msg)
+        return res
+
+    def get_messages(self, chat_id: int, message_ids: int | list):
+        self._call("get_messages", chat_id)
+        if isinstance(message_ids, list):
+            return [self.messages.get((chat_id, i)) or self._new_message(chat_id) for i in message_ids]
+        return self.messages.get((chat_id, message_ids)) or self._new_message(chat_id)
+
+    def forward_messages(self, chat_id: int, from_chat_id: int, message_ids: int | list, **kwargs):
+        self._call("forward_messages", chat_id, message=True)
+        res = []
+        for i in message_ids if isinstance(message_ids, list) else [message_ids]:
+            original = self.messages.get((from_chat_id, i))
+            msg = self._new_message(chat_id)
+            if original:
+                msg.__dict__.update({k: v for k, v in original.__dict__.items() if k not in ("id", "chat")})
+            res.append(msg)
+        return res if isinstance(message_ids, list) else res[0]
+
+    def send_chat_action(self, chat_id: int, action):
+        self._call("send_chat_action", chat_id)
+        return True
+
+    # raw api, as used by send_media_group and stream_upload
+
+    def save_file(self, path, progress=None, progress_args=()):
+        self._call("save_file")
+        self._upload(path, progress, progress_args)
+        return raw.types.InputFile(id=next(self.ids), parts=1, name=pathlib.Path(path).name, md5_checksum="")
+
+    def resolve_peer(self, chat_id: int):
+        return raw.types.InputPeerUser(user_id=chat_id, access_hash=0)
+
+    def rnd_id(self) -> int:
+        return self.random.getrandbits(63)
+
+    def guess_mime_type(self, filename: str) -> str | None:
+        return None
+
+    def invoke(self, query):
+        name = type(query).__name__
+        if isinstance(query, raw.functions.upload.SaveBigFilePart):
+            self._call(name)
+            self._transfer(len(query.bytes))
+            with self.lock:
+                self.stats["uploaded_bytes"] += len(query.bytes)
+            return True
+        if isinstance(query, raw.functions.messages.UploadMedia):
+            self._call(name)
+            media_id = next(self.ids)
+            if isinstance(query.media, raw.types.InputMediaUploadedPhoto):
+                size = raw.types.PhotoSize(type="y", w=1, h=1, size=1)
+                photo = raw.types.Photo(
+                    id=media_id, access_hash=media_id, file_reference=b"", date=0, sizes=[size], dc_id=2
+                )
+                return raw.types.MessageMediaPhoto(photo=photo)
+            document = raw.types.Document(
+                id=media_id,
+                access_hash=media_id,
+                file_reference=b"",
+                date=0,
+                mime_type=query.media.mime_type,
+                size=0,
+                dc_id=2,
+                attributes=query.media.attributes,
+            )
+            return raw.types.MessageMediaDocument(document=document)
+        if isinstance(query, raw.functions.messages.SendMedia):
+            self._call(name, query.peer.user_id, message=True)
+            return raw.types.Updates(updates=[], users=[], chats=[], date=0, seq=0)
+        raise NotImplementedError(name)
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# ytdlbot - load_test.py
+# simulated users send links to download_handler through the fake client, to see where the bot saturates
+# usage: cd ytdlbot && python ../scripts/load_test.py --users 1000 --rate 50 --bandwidth 20 -o load.json 2>/dev/null
+
+import argparse
+import collections
+import concurrent.futures
+import json
+import logging
+import random
+import threading
+import time
+
+# bench_pipeline sets up the environment and the import path of the bot
+from bench_pipeline import WORKDIR, generate_samples, revision, serve
+from fake_client import FakeClient
+
+import ytdl_bot
+from config import PYRO_WORKERS
+from tracing import percentile
+
+
+def summary(values: list) -> dict:
+    if not values:
+        return {}
+    return {
+        "p50": round(percentile(values, 0.5), 3),
+        "p95": round(percentile(values, 0.95), 3),
+        "max": round(max(values), 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-u", "--users", type=int, default=200, help="number of simulated users, one link each")
+    parser.add_argument("--rate", type=float, default=20, help="users arriving per second")
+    parser.add_argument("--links", type=int, default=20, help="distinct links, popular ones are sent more often")
+    parser.add_argument("--workers", type=int, default=PYRO_WORKERS, help="handler threads, like pyrogram workers")
+    parser.add_argument("--bandwidth", type=float, default=0, help="upload bandwidth in MB/s, 0 for unlimited")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds per API call")
+    parser.add_argument("--flood-rate", type=float, default=0, help="chance of a FloodWait on any API call")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("-o", "--output", help="write the results to this json file")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    sizes = generate_samples(WORKDIR.joinpath("samples"), 0)
+    base = serve(WORKDIR.joinpath("samples"))
+    names = list(sizes)
+    # a new link for every run, so the send cache of earlier runs doesn't answer them
+    links = [f"{base}/{names[i % len(names)]}?link={i}-{time.time()}" for i in range(args.links)]
+    rand = random.Random(args.seed)
+    # zipf like popularity, the first links get most of the requests
+    weights = [1 / (i + 1) for i in range(args.links)]
+
+    client = FakeClient(
+        bandwidth=args.bandwidth * 1024**2, latency=args.latency, flood_rate=args.flood_rate, seed=args.seed
+    )
+    waits, durations, errors = [], [], collections.Counter()
+    lock = threading.Lock()
+
+    def user(n: int, url: str, arrived: float):
+        start = time.time()
+        message = client.incoming(100000 + n, url)
+        try:
+            ytdl_bot.download_handler(client, message)
+        except Exception as e:
+            with lock:
+                errors[type(e).__name__] += 1
+        with lock:
+            waits.append(start - arrived)
+            durations.append(time.time() - arrived)
+
+    start = time.time()
+    with concurrent.futures.ThreadPoolExecutor(args.workers) as executor:
+        for n in range(args.users):
+            executor.submit(user, n, rand.choices(links, weights)[0], time.time())
+            time.sleep(1 / args.rate)
+    wall = time.time() - start
+
+    outcomes = collections.Counter()
+    for msg in list(client.messages.values()):
+        text = msg.text or ""
+        if text.startswith("Download success"):
+            outcomes["success"] += 1
+        elif text.startswith("Download failed"):
+            outcomes["failed"] += 1
+
+    result = {
+        "revision": revision(),
+        "users": args.users,
+        "rate": args.rate,
+        "links": args.links,
+        "workers": args.workers,
+        "bandwidth": args.bandwidth,
+        "latency": args.latency,
+        "flood_rate": args.flood_rate,
+        "wall": round(wall, 3),
+        "users_per_s": round(args.users / wall, 3),
+        "queue_wait": summary(waits),
+        "duration": summary(durations),
+        "outcomes": dict(outcomes),
+        "errors": dict(errors),
+        "client": dict(client.stats),
+    }
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,27 @@
 #!/usr/bin/env python3
 # coding: utf-8
+import functools
 import http
 import logging
 import os
 import re
+from urllib.parse import parse_qsl, urlencode, urlsplit
 
 import requests
 from bs4 import BeautifulSoup
+from yt_dlp.extractor import gen_extractor_classes
 
 from config import ENABLE_VIP
 from limit import Payment
 
+# share and tracking parameters that don't change what gets downloaded
+TRACKING_PARAMS = {"si", "feature", "spm_id_from", "vd_source", "share_source"}
+
+
+@functools.lru_cache
+def extractor_classes() -> list:
+    return [ie for ie in gen_extractor_classes() if ie.ie_key() != "Generic"]
+
 
 class Channel(Payment):
     def subscribe_channel(self, user_id: int, share_link: str) -> str:
@@ -76,6 +87,36 @@ class Channel(Payment):
 
         return url
 
+    @staticmethod
+    def match_extractor(url: str) -> str | None:
+        # extractor:video_id from the url patterns of yt-dlp, no network at all.
+        # like yt-dlp, the first suitable extractor wins
+        for ie in extractor_classes():
+            if ie.suitable(url):
+                try:
+                    video_id = ie._match_id(url)
+                except (IndexError, AttributeError):
+                    return None
+                if not video_id:
+                    return None
+                # the id alone isn't always the content, e.g. the parts of a bilibili video are ?p=2, ?p=3...
+                query = [
+                    (key, value)
+                    for key, value in sorted(parse_qsl(urlsplit(url).query))
+                    if value != video_id and key not in TRACKING_PARAMS and not key.startswith("utm_")
+                ]
+                return f"{ie.ie_key()}:{video_id}" + (f"?{urlencode(query)}" if query else "")
+
+    def get_canonical_link(self, url: str) -> str:
+        if clink := self.match_extractor(url):
+            return clink
+        # unknown sites: HEAD and GET are expensive, share the result between link_checker and get_unique_clink
+        if clink := self.get_clink_cache(url):
+            return clink
+        clink = self.extract_canonical_link(url)
+        self.add_clink_cache(url, clink)
+        return clink
+
     def get_channel_info(self, url: str) -> dict:
         api_key = os.getenv("GOOGLE_API_KEY")
         canonical_link = self.extract_canonical_link(url)
@@ -167,13 +208,9 @@ class Channel(Payment):
         return text
 
     def del_cache(self, user_link: str) -> int:
-        unique = self.extract_canonical_link(user_link)
-        caches = self.r.hgetall("cache")
-        count = 0
-        for key in caches:
-            if key.startswith(unique):
-                count += self.del_send_cache(key)
-        return count
+        clink = self.get_canonical_link(user_link)
+        uniques = self.r.smembers(f"send_index:{clink}") | set(self.legacy_send_cache(clink))
+        return sum(self.del_send_cache(unique) for unique in uniques)
 
 
 if __name__ == "__main__":
@@ -6,6 +6,13 @@ from blinker import signal
 # general settings
 WORKERS: int = int(os.getenv("WORKERS", 10))
 PYRO_WORKERS: int = int(os.getenv("PYRO_WORKERS", 100))
+# celery: every kind of task has its own queue and worker threads, a worker only consumes the queues in CELERY_QUEUES
+CELERY_QUEUES = os.getenv("CELERY_QUEUES", "download,transcode,direct").split(",")
+DOWNLOAD_WORKERS: int = int(os.getenv("DOWNLOAD_WORKERS", WORKERS))
+TRANSCODE_WORKERS: int = int(os.getenv("TRANSCODE_WORKERS", os.cpu_count() or 1))
+DIRECT_WORKERS: int = int(os.getenv("DIRECT_WORKERS", max(1, WORKERS // 2)))
+# ffmpeg processes running at once in each process, more conversions wait for a free core
+FFMPEG_WORKERS: int = int(os.getenv("FFMPEG_WORKERS", os.cpu_count() or 1))
 APP_ID: int = int(os.getenv("APP_ID", 1234))
 APP_HASH = os.getenv("APP_HASH", "")
 TOKEN = os.getenv("TOKEN", "")
@@ -18,6 +25,18 @@ TG_NORMAL_MAX_SIZE = 2000 * 1024 * 1024
 
 
 EXPIRE = 24 * 3600
+# how long an extracted info dict stays in redis, shared by get_unique_clink and ytdl_download
+INFO_EXPIRE = int(os.getenv("INFO_EXPIRE", 1800))
+# user settings and tokens are cached in each process for this many seconds
+PROFILE_EXPIRE = int(os.getenv("PROFILE_EXPIRE", 10))
+# send cache: entries expire after this many seconds without access, the least recently used go first above the cap
+SEND_CACHE_EXPIRE = int(os.getenv("SEND_CACHE_EXPIRE", 30 * 24 * 3600))
+SEND_CACHE_SIZE = int(os.getenv("SEND_CACHE_SIZE", 1000000))
+# single flight: one download of a link at a time, other requests are queued and get its file id when it's done.
+# if the worker dies, the next request of the link takes over after this many seconds
+FLIGHT_TIMEOUT = int(os.getenv("FLIGHT_TIMEOUT", 1800))
+# when that download fails, the queued requests try again this many times before they are told it failed
+FLIGHT_RETRIES = int(os.getenv("FLIGHT_RETRIES", 1))
 
 ENABLE_VIP = os.getenv("VIP", True)
 OWNER = os.getenv("OWNER", "Abel360w")
@@ -44,19 +63,34 @@ AUDIO_FORMAT = os.getenv("AUDIO_FORMAT")
 ARCHIVE_ID = os.getenv("ARCHIVE_ID")
 
 IPv6 = os.getenv("IPv6", False)
+# extract once and walk the format fallback chain against the info dict in memory
+LOCAL_FORMAT_SELECTION = os.getenv("LOCAL_FORMAT_SELECTION", True)
 ENABLE_FFMPEG = os.getenv("ENABLE_FFMPEG", False)
+# split files over TG_NORMAL_MAX_SIZE into parts instead of aborting, when there's no premium account
+SPLIT_LARGE_VIDEO = os.getenv("SPLIT_LARGE_VIDEO", False)
 
 PLAYLIST_SUPPORT = os.getenv("PLAYLIST_SUPPORT", False)
 M3U8_SUPPORT = os.getenv("M3U8_SUPPORT", False)
 ENABLE_ARIA2 = os.getenv("ENABLE_ARIA2", False)
 
 RATE_LIMIT = os.getenv("RATE_LIMIT", 120)
+# progress message edits: global edits per second of one process, and seconds between edits of the same message
+EDIT_RATE = float(os.getenv("EDIT_RATE", 10))
+EDIT_INTERVAL = float(os.getenv("EDIT_INTERVAL", 5))
 RCLONE_PATH = os.getenv("RCLONE")
 # This will set the value for the tmpfile path(download path) if it is set.
 # If TMPFILE is not set, it will return None and use system’s default temporary file path.
 # Please ensure that the directory exists and you have necessary permissions to write to it.
 # If you don't know what this is just leave it as it is.
 TMPFILE_PATH = os.getenv("TMPFILE")
+# one json line per task with the time of each stage, default: ytdl-trace.jsonl in the tmpfile path
+TRACE_FILE = os.getenv("TRACE_FILE")
+# /direct: upload to telegram while downloading. Parts are buffered in memory first, then in a small spill file.
+DIRECT_STREAMING = os.getenv("DIRECT_STREAMING", False)
+STREAM_BUFFER = int(os.getenv("STREAM_BUFFER", 32))
+STREAM_SPILL_SIZE = int(os.getenv("STREAM_SPILL_SIZE", 64 * 1024 * 1024))
+# /direct: parallel connections when the server supports range requests, 1 to disable
+DIRECT_CONNECTIONS = int(os.getenv("DIRECT_CONNECTIONS", 8))
 
 # payment settings
 AFD_LINK = os.getenv("AFD_LINK", "None")
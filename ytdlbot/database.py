@@ -1,14 +1,19 @@
 
 
+import atexit
 import base64
+import collections
 import contextlib
 import datetime
+import json
 import logging
 import os
 import re
 import sqlite3
 import subprocess
+import threading
 import time
+import uuid
 from io import BytesIO
 
 import fakeredis
@@ -18,7 +23,46 @@ import requests
 from beautifultable import BeautifulTable
 from influxdb import InfluxDBClient
 
-from config import IS_BACKUP_BOT, MYSQL_HOST, MYSQL_PASS, MYSQL_USER, REDIS
+from config import (
+    FLIGHT_TIMEOUT,
+    INFO_EXPIRE,
+    IS_BACKUP_BOT,
+    MYSQL_HOST,
+    MYSQL_PASS,
+    MYSQL_USER,
+    REDIS,
+    SEND_CACHE_EXPIRE,
+    SEND_CACHE_SIZE,
+)
+from tracing import percentile
+
+# KEYS[1]: flight key, KEYS[2]: its waiter list, ARGV[1]: waiter, ARGV[2]: ttl. Queued only while the flight is held
+FLIGHT_JOIN_SCRIPT = """
+if redis.call("EXISTS", KEYS[1]) == 1 then
+    redis.call("RPUSH", KEYS[2], ARGV[1])
+    redis.call("EXPIRE", KEYS[2], ARGV[2])
+    return 1
+end
+return 0
+"""
+# KEYS[1]: flight key, KEYS[2]: its waiter list, ARGV[1]: token of the holder.
+# Only the holder releases it, and takes the waiters with it. nil if it wasn't held by this token
+FLIGHT_RELEASE_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    redis.call("DEL", KEYS[1])
+    local waiters = redis.call("LRANGE", KEYS[2], 0, -1)
+    redis.call("DEL", KEYS[2])
+    return waiters
+end
+return false
+"""
+
+# stage durations of every worker are kept in redis for this long, and at most this many of each stage
+STAGE_WINDOW = 3600
+STAGE_SAMPLES = 10000
+
+# the fake fallbacks are only used for this many seconds, then the real server is tried again
+RECONNECT_INTERVAL = 30
 
 init_con = sqlite3.connect(":memory:", check_same_thread=False)
 
@@ -62,21 +106,64 @@ class Cursor:
         return sql
 
 
-class Redis:
-    def __init__(self):
-        db = 1 if IS_BACKUP_BOT else 0
+class MetricsBuffer:
+    """
+    Counters of the metrics hash, added up in process and written to redis in one pipeline every few seconds.
+    """
+
+    def __init__(self, interval: float = 5):
+        self.interval = interval
+        self.counts = collections.Counter()
+        self.lock = threading.Lock()
+        self.pid = None
+        atexit.register(self.flush)
+
+    def add(self, key: str | int, amount: int = 1):
+        with self.lock:
+            self.counts[key] += amount
+            # started lazily, a forked celery worker needs its own thread
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                threading.Thread(target=self._run, daemon=True).start()
+
+    def flush(self):
+        with self.lock:
+            counts, self.counts = self.counts, collections.Counter()
+        if not counts:
+            return
         try:
-            self.r = redis.StrictRedis(host=REDIS, db=db, decode_responses=True)
-            self.r.ping()
-        except Exception:
-            logging.warning("Redis connection failed, using fake redis instead.")
-            self.r = fakeredis.FakeStrictRedis(host=REDIS, db=db, decode_responses=True)
+            with Redis.connect().pipeline(transaction=False) as pipe:
+                for key, amount in counts.items():
+                    pipe.hincrby("metrics", key, amount)
+                pipe.execute()
+        except Exception as e:
+            logging.error("Failed to flush metrics: %s", e)
+            with self.lock:
+                self.counts.update(counts)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
 
+metrics = MetricsBuffer()
+
+
+class Redis:
+    # one client for the whole process, its connection pool is thread safe
+    _r = None
+    _lock = threading.Lock()
+    # set while the fake redis is in use
+    _retry_at = 0
+
+    def __init__(self):
         db_banner = "=" * 20 + "DB data" + "=" * 20
         quota_banner = "=" * 20 + "Celery" + "=" * 20
         metrics_banner = "=" * 20 + "Metrics" + "=" * 20
         usage_banner = "=" * 20 + "Usage" + "=" * 20
         vnstat_banner = "=" * 20 + "vnstat" + "=" * 20
+        stage_banner = "=" * 20 + f"Stages(last {STAGE_WINDOW // 60} minutes)" + "=" * 20
         self.final_text = f"""
 {db_banner}
 %s
@@ -95,19 +182,40 @@ class Redis:
 
 
 {usage_banner}
+%s
+
+
+{stage_banner}
 %s
         """
         super().__init__()
 
-    def __del__(self):
-        self.r.close()
-
-    def update_metrics(self, metrics: str):
-        logging.info(f"Setting metrics: {metrics}")
-        all_ = f"all_{metrics}"
-        today = f"today_{metrics}"
-        self.r.hincrby("metrics", all_)
-        self.r.hincrby("metrics", today)
+    @classmethod
+    def connect(cls):
+        if cls._r is None or 0 < cls._retry_at < time.time():
+            with cls._lock:
+                if cls._r is None or 0 < cls._retry_at < time.time():
+                    db = 1 if IS_BACKUP_BOT else 0
+                    try:
+                        r = redis.StrictRedis(host=REDIS, db=db, decode_responses=True)
+                        r.ping()
+                        Redis._retry_at = 0
+                    except Exception:
+                        logging.warning("Redis connection failed, using fake redis instead.")
+                        # keep what the fake one has got so far
+                        r = cls._r or fakeredis.FakeStrictRedis(host=REDIS, db=db, decode_responses=True)
+                        Redis._retry_at = time.time() + RECONNECT_INTERVAL
+                    Redis._r = r
+        return cls._r
+
+    @property
+    def r(self):
+        return self.connect()
+
+    def update_metrics(self, metrics_name: str):
+        logging.debug("Setting metrics: %s", metrics_name)
+        metrics.add(f"all_{metrics_name}")
+        metrics.add(f"today_{metrics_name}")
 
     @staticmethod
     def generate_table(header, all_data: list):
@@ -119,6 +227,7 @@ class Redis:
         return table
 
     def show_usage(self):
+        metrics.flush()
         db = MySQL()
         db.cur.execute("select user_id,payment_amount,old_user,token from payment")
         data = db.cur.fetchall()
@@ -167,9 +276,34 @@ class Redis:
         else:
             cmd = "/usr/bin/vnstat -i eth0".split()
         vnstat_text = subprocess.check_output(cmd).decode("u8")
-        return self.final_text % (db_text, vnstat_text, worker_text, metrics_text, usage_text)
+
+        stage_text = self.generate_table(["stage", "count", "p50(s)", "p95(s)"], self.stage_percentiles())
+        return self.final_text % (db_text, vnstat_text, worker_text, metrics_text, usage_text, stage_text)
+
+    def add_stage_durations(self, trace: dict):
+        # stage:{name} is a sorted set of "seconds:random" scored by the time it finished, trimmed to STAGE_WINDOW
+        now = time.time()
+        durations = [("total", trace["seconds"])] + [(s["stage"], s["seconds"]) for s in trace["spans"]]
+        with self.r.pipeline() as pipe:
+            for stage, seconds in durations:
+                pipe.sadd("stages", stage)
+                pipe.zadd(f"stage:{stage}", {f"{seconds}:{uuid.uuid4().hex[:8]}": now})
+                pipe.zremrangebyscore(f"stage:{stage}", 0, now - STAGE_WINDOW)
+                pipe.zremrangebyrank(f"stage:{stage}", 0, -STAGE_SAMPLES - 1)
+                pipe.expire(f"stage:{stage}", STAGE_WINDOW)
+            pipe.execute()
+
+    def stage_percentiles(self) -> list:
+        # [stage, count, p50, p95] of every stage in the last STAGE_WINDOW, plus the whole task, from all workers
+        rows = []
+        for stage in sorted(self.r.smembers("stages")):
+            members = self.r.zrangebyscore(f"stage:{stage}", time.time() - STAGE_WINDOW, "+inf")
+            if values := [float(m.split(":")[0]) for m in members]:
+                rows.append([stage, len(values), percentile(values, 0.5), percentile(values, 0.95)])
+        return rows
 
     def reset_today(self):
+        metrics.flush()
         pairs = self.r.hgetall("metrics")
         for k in pairs:
             if k.startswith("today"):
@@ -178,7 +312,7 @@ class Redis:
         self.r.delete("premium")
 
     def user_count(self, user_id):
-        self.r.hincrby("metrics", user_id)
+        metrics.add(user_id)
 
     def generate_file(self):
         text = self.show_usage()
@@ -188,14 +322,131 @@ class Redis:
         file.name = f"{date}.txt"
         return file
 
-    def add_send_cache(self, unique: str, file_id: str):
-        self.r.hset("cache", unique, file_id)
-
-    def get_send_cache(self, unique) -> str:
-        return self.r.hget("cache", unique)
-
-    def del_send_cache(self, unique):
-        return self.r.hdel("cache", unique)
+    def add_send_cache(self, unique: str, file_id: str | list, clink: str):
+        # every entry is its own key with a ttl. send_index:{clink} holds the variants of a link for invalidation,
+        # send_atime is the last access time of every entry, for eviction.
+        # media groups are stored as a json list of file ids, in the order they were sent
+        if isinstance(file_id, list):
+            file_id = json.dumps(file_id)
+        now = time.time()
+        with self.r.pipeline() as pipe:
+            pipe.hset(f"send:{unique}", mapping={"file_id": file_id, "clink": clink})
+            pipe.expire(f"send:{unique}", SEND_CACHE_EXPIRE)
+            pipe.sadd(f"send_index:{clink}", unique)
+            pipe.expire(f"send_index:{clink}", SEND_CACHE_EXPIRE)
+            pipe.zadd("send_atime", {unique: now})
+            # these have expired already
+            pipe.zremrangebyscore("send_atime", 0, now - SEND_CACHE_EXPIRE)
+            pipe.zcard("send_atime")
+            size = pipe.execute()[-1]
+
+        if size > SEND_CACHE_SIZE:
+            for key, _ in self.r.zpopmin("send_atime", size - SEND_CACHE_SIZE):
+                logging.info("Evicting send cache %s", key)
+                self.del_send_cache(key)
+
+    def get_send_cache(self, unique) -> str | list:
+        entry = self.r.hgetall(f"send:{unique}")
+        if not entry:
+            return self.migrate_send_cache(unique)
+        with self.r.pipeline() as pipe:
+            pipe.zadd("send_atime", {unique: time.time()})
+            pipe.expire(f"send:{unique}", SEND_CACHE_EXPIRE)
+            pipe.expire(f"send_index:{entry['clink']}", SEND_CACHE_EXPIRE)
+            pipe.execute()
+
+        file_id = entry["file_id"]
+        if file_id.startswith("["):
+            return json.loads(file_id)
+        return file_id
+
+    def migrate_send_cache(self, unique) -> str | list:
+        # entries of the old single "cache" hash are moved to their own key when they're read
+        file_id = self.r.hget("cache", unique)
+        if file_id is None:
+            return None
+        logging.info("Migrating send cache %s", unique)
+        # the unique key is the canonical link plus the user's settings, see get_unique_clink
+        self.add_send_cache(unique, file_id, unique.rsplit("?p=", 1)[0])
+        self.r.hdel("cache", unique)
+        if file_id.startswith("["):
+            return json.loads(file_id)
+        return file_id
+
+    def rekey_send_cache(self, match) -> int:
+        # the old "cache" hash is keyed by canonical urls, links of known sites are extractor:id now.
+        # match is Channel.match_extractor. Runs once, entries are moved to their own key when they're read
+        if self.r.exists("cache_rekeyed"):
+            return 0
+        count = 0
+        for unique, file_id in self.r.hscan_iter("cache"):
+            clink, sep, settings = unique.rpartition("?p=")
+            if not sep:
+                clink, settings = unique, ""
+            new_clink = match(clink)
+            if new_clink and new_clink != clink:
+                with self.r.pipeline() as pipe:
+                    pipe.hset("cache", f"{new_clink}{sep}{settings}", file_id)
+                    pipe.hdel("cache", unique)
+                    pipe.execute()
+                count += 1
+        self.r.set("cache_rekeyed", 1)
+        logging.info("Rekeyed %s send cache entries", count)
+        return count
+
+    def legacy_send_cache(self, clink: str) -> list:
+        # variants of a link that are still in the old "cache" hash
+        pattern = re.sub(r"([*?\[\]\\])", r"\\\1", clink) + "*"
+        # the settings come last, BiliBili:x?p=2?p=... is another link than BiliBili:x?p=...
+        return [
+            key
+            for key, _ in self.r.hscan_iter("cache", match=pattern)
+            if key.rpartition("?p=")[0] == clink or key == clink
+        ]
+
+    def del_send_cache(self, unique) -> int:
+        clink = self.r.hget(f"send:{unique}", "clink")
+        with self.r.pipeline() as pipe:
+            pipe.delete(f"send:{unique}")
+            pipe.hdel("cache", unique)
+            pipe.zrem("send_atime", unique)
+            if clink:
+                pipe.srem(f"send_index:{clink}", unique)
+            return sum(pipe.execute()[:2])
+
+    def acquire_flight(self, unique: str, token: str) -> bool:
+        # single flight: one download of the same link and settings at a time, across all bots and workers
+        return bool(self.r.set(f"flight:{unique}", token, nx=True, ex=FLIGHT_TIMEOUT))
+
+    def join_flight(self, unique: str, waiter: dict) -> bool:
+        # queue a request behind the download of the same link, nothing waits. False if the flight has landed already.
+        # the queue outlives a dead holder, so the next download of the link serves it
+        keys = [f"flight:{unique}", f"flight_waiters:{unique}"]
+        args = [json.dumps(waiter), FLIGHT_TIMEOUT * 2]
+        return bool(self.r.register_script(FLIGHT_JOIN_SCRIPT)(keys=keys, args=args))
+
+    def release_flight(self, unique: str, token: str) -> list | None:
+        # the requests that were queued behind this download, None if this token doesn't hold the flight
+        keys = [f"flight:{unique}", f"flight_waiters:{unique}"]
+        waiters = self.r.register_script(FLIGHT_RELEASE_SCRIPT)(keys=keys, args=[token])
+        if waiters is not None:
+            return [json.loads(waiter) for waiter in waiters]
+
+    def add_info_cache(self, url: str, info: dict):
+        self.r.set(f"info:{url}", json.dumps(info), ex=INFO_EXPIRE)
+
+    def get_info_cache(self, url: str) -> dict:
+        if data := self.r.get(f"info:{url}"):
+            return json.loads(data)
+
+    def del_info_cache(self, url: str):
+        return self.r.delete(f"info:{url}")
+
+    def add_clink_cache(self, url: str, clink: str):
+        self.r.set(f"clink:{url}", clink, ex=INFO_EXPIRE)
+
+    def get_clink_cache(self, url: str) -> str:
+        return self.r.get(f"clink:{url}")
 
 
 class MySQL:
@@ -246,21 +497,52 @@ class MySQL:
     ) CHARSET=utf8mb4;
     """
 
-    def __init__(self):
-        try:
-            self.con = pymysql.connect(
-                host=MYSQL_HOST, user=MYSQL_USER, passwd=MYSQL_PASS, db="ytdl", charset="utf8mb4"
-            )
-            self.con.ping(reconnect=True)
-        except Exception:
-            logging.warning("MySQL connection failed, using fake mysql instead.")
-            self.con = FakeMySQL()
+    # pymysql connections can't be shared between threads, so every thread keeps one for the whole process
+    _local = threading.local()
+    _lock = threading.Lock()
+    _initialized = False
 
-        self.con.ping(reconnect=True)
-        self.cur = self.con.cursor()
-        self.init_db()
+    def __init__(self):
+        if not MySQL._initialized:
+            with MySQL._lock:
+                if not MySQL._initialized:
+                    self.init_db()
+                    MySQL._initialized = True
         super().__init__()
 
+    def _connection(self) -> tuple:
+        local = self._local
+        # a forked celery worker must not talk over the connection of its parent
+        if getattr(local, "pid", None) != os.getpid() or 0 < getattr(local, "retry_at", 0) < time.time():
+            try:
+                # autocommit, or a long-lived connection would keep reading from an old snapshot
+                local.con = pymysql.connect(
+                    host=MYSQL_HOST, user=MYSQL_USER, passwd=MYSQL_PASS, db="ytdl", charset="utf8mb4", autocommit=True
+                )
+                # the tables may have been created in the fake one only
+                recovered, local.retry_at = bool(getattr(local, "retry_at", 0)), 0
+            except Exception:
+                logging.warning("MySQL connection failed, using fake mysql instead.")
+                local.con = FakeMySQL()
+                recovered, local.retry_at = False, time.time() + RECONNECT_INTERVAL
+            local.cur = local.con.cursor()
+            local.pid = os.getpid()
+            local.last_used = time.time()
+            if recovered:
+                self.init_db()
+        elif time.time() - local.last_used > 30:
+            local.con.ping(reconnect=True)
+        local.last_used = time.time()
+        return local.con, local.cur
+
+    @property
+    def con(self):
+        return self._connection()[0]
+
+    @property
+    def cur(self):
+        return self._connection()[1]
+
     def init_db(self):
         self.cur.execute(self.vip_sql)
         self.cur.execute(self.settings_sql)
@@ -268,9 +550,6 @@ class MySQL:
         self.cur.execute(self.subscribe_sql)
         self.con.commit()
 
-    def __del__(self):
-        self.con.close()
-
     def get_user_settings(self, user_id: int) -> tuple:
         self.cur.execute("SELECT * FROM settings WHERE user_id = %s", (user_id,))
         data = self.cur.fetchone()
@@ -1,73 +1,187 @@
 
 
+import collections
+import concurrent.futures
+import contextlib
+import copy
 import functools
+import glob
+import hashlib
+import json
 import logging
+import math
 import os
 import pathlib
 import re
+import socket
 import subprocess
+import tempfile
 import threading
 import time
 import traceback
-from io import StringIO
+import typing
+import uuid
+from io import BytesIO
 from unittest.mock import MagicMock
 
 import ffmpeg
 import ffpb
 import filetype
+import pyrogram.errors
 import requests
 import yt_dlp as ytdl
-from pyrogram import types
+from PIL import Image
+from pyrogram import raw, types
 from tqdm import tqdm
 
 from config import (
     AUDIO_FORMAT,
+    DIRECT_CONNECTIONS,
+    EDIT_INTERVAL,
+    EDIT_RATE,
     ENABLE_ARIA2,
     ENABLE_FFMPEG,
+    FFMPEG_WORKERS,
+    LOCAL_FORMAT_SELECTION,
     PREMIUM_USER,
+    SPLIT_LARGE_VIDEO,
+    STREAM_BUFFER,
+    STREAM_SPILL_SIZE,
     TG_NORMAL_MAX_SIZE,
     TG_PREMIUM_MAX_SIZE,
+    TMPFILE_PATH,
     FileTooBig,
     IPv6,
 )
+from database import Redis
+from keep_alive import CACHE_REQUESTS, FLOOD_WAITS, TRANSFER_BYTES
 from limit import Payment
-from utils import adjust_formats, apply_log_formatter, current_time, sizeof_fmt
+from tracing import add_tags, span
+from utils import (
+    THUMBNAIL_PATH,
+    adjust_formats,
+    apply_log_formatter,
+    current_time,
+    guess_mime,
+    probe_media,
+    sizeof_fmt,
+)
 
 apply_log_formatter()
 
 
-def debounce(wait_seconds):
+class EditDispatcher:
     """
-    Thread-safe debounce decorator for functions that take a message with chat.id and msg.id attributes.
-    The function will only be called if it hasn't been called with the same chat.id and msg.id in the last 'wait_seconds'.
+    Per-process dispatcher for message edits, shared by every download thread of this process.
+    Only the latest text of each message is kept, edits are sent from one loop under a global edits-per-second
+    budget, and each message is edited at most once every 'interval' seconds. The last text is always delivered.
     """
 
-    def decorator(func):
-        last_called = {}
-        lock = threading.Lock()
-
-        @functools.wraps(func)
-        def wrapper(*args, **kwargs):
-            nonlocal last_called
+    def __init__(self, rate: float, interval: float):
+        self.rate = rate
+        self.interval = interval
+        # (chat.id, msg.id) -> (bot_msg, text)
+        self.pending = {}
+        # (chat.id, msg.id) -> last time this message was edited, pruned once it's older than interval
+        self.last_sent = {}
+        self.sending = set()
+        self.cond = threading.Condition()
+        self.budget_lock = threading.Lock()
+        self.next_slot = 0
+        self.thread = None
+
+    @staticmethod
+    def _key(bot_msg) -> tuple:
+        return bot_msg.chat.id, bot_msg.id
+
+    def submit(self, bot_msg: types.Message, text: str | typing.Callable[[], str]):
+        with self.cond:
+            self.pending[self._key(bot_msg)] = (bot_msg, text)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="edit-dispatcher", daemon=True)
+                self.thread.start()
+            self.cond.notify()
+
+    def flush(self, bot_msg: types.Message, text: str, **kwargs):
+        # drop the pending progress of this message and send this edit right now, nothing queued can overwrite it
+        key = self._key(bot_msg)
+        with self.cond:
+            self.pending.pop(key, None)
+            self.cond.wait_for(lambda: key not in self.sending)
+            self.last_sent.pop(key, None)
+        self._acquire()
+        return bot_msg.edit_text(text, **kwargs)
+
+    def _acquire(self):
+        # global budget: edits are spaced 1/rate seconds apart, no matter which thread sends them
+        with self.budget_lock:
             now = time.time()
-
-            # Assuming the first argument is the message object with chat.id and msg.id
-            bot_msg = args[0]
-            key = (bot_msg.chat.id, bot_msg.id)
-
-            with lock:
-                if key not in last_called or now - last_called[key] >= wait_seconds:
-                    last_called[key] = now
-                    return func(*args, **kwargs)
-
-        return wrapper
-
-    return decorator
-
-
-@debounce(5)
-def edit_text(bot_msg: types.Message, text: str):
-    bot_msg.edit_text(text)
+            wait = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + 1 / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+    def _next(self) -> tuple:
+        with self.cond:
+            while True:
+                now = time.time()
+                for key, ts in list(self.last_sent.items()):
+                    if now - ts >= self.interval and key not in self.pending:
+                        del self.last_sent[key]
+
+                due = [key for key in self.pending if now - self.last_sent.get(key, 0) >= self.interval]
+                if due:
+                    # the message waiting the longest goes first
+                    key = min(due, key=lambda k: self.last_sent.get(k, 0))
+                    self.last_sent[key] = now
+                    self.sending.add(key)
+                    return key, *self.pending.pop(key)
+
+                # wake up when the next message is due, or when the finished ones can be evicted
+                idle = self.interval if self.last_sent else None
+                timeout = min((self.last_sent[k] + self.interval - now for k in self.pending), default=idle)
+                self.cond.wait(timeout)
+
+    def _run(self):
+        while True:
+            key, bot_msg, text = self._next()
+            try:
+                self._acquire()
+                if callable(text):
+                    # progress text is rendered only when the edit is really going to be sent
+                    text = text()
+                bot_msg.edit_text(text)
+            except pyrogram.errors.FloodWait as e:
+                logging.warning("FloodWait %s seconds for message edits", e.value)
+                FLOOD_WAITS.labels("edit").inc()
+                with self.budget_lock:
+                    self.next_slot = max(self.next_slot, time.time() + e.value)
+                with self.cond:
+                    # retry later unless a newer text has arrived in the meantime
+                    self.pending.setdefault(key, (bot_msg, text))
+            except pyrogram.errors.MessageNotModified:
+                pass
+            except Exception as e:
+                logging.warning("Failed to edit message %s: %s", key, e)
+            finally:
+                with self.cond:
+                    self.sending.discard(key)
+                    self.cond.notify_all()
+
+
+dispatcher = EditDispatcher(EDIT_RATE, EDIT_INTERVAL)
+# IPv6 goes first
+SOURCE_ADDRESSES = ["::", "0.0.0.0"] if IPv6 else [None]
+ffmpeg_slots = threading.BoundedSemaphore(FFMPEG_WORKERS)
+instagram_session = requests.Session()
+
+
+def edit_text(bot_msg: types.Message, text: str | typing.Callable[[], str]):
+    dispatcher.submit(bot_msg, text)
+
+
+def flush_text(bot_msg: types.Message, text: str, **kwargs):
+    return dispatcher.flush(bot_msg, text, **kwargs)
 
 
 def tqdm_progress(desc, total, finished, speed="", eta=""):
@@ -77,18 +191,18 @@ def tqdm_progress(desc, total, finished, speed="", eta=""):
         else:
             return ""
 
-    f = StringIO()
-    tqdm(
-        total=total,
-        initial=finished,
-        file=f,
+    # format_meter is what a tqdm instance renders with, minus the file, lock and instance bookkeeping
+    line = tqdm.format_meter(
+        finished,
+        total,
+        0,
+        ncols=30,
         ascii=False,
         unit_scale=True,
-        ncols=30,
         bar_format="{l_bar}{bar} |{n_fmt}/{total_fmt} ",
     )
-    raw_output = f.getvalue()
-    tqdm_output = raw_output.split("|")
+    # a tqdm instance writes the line twice: on creation and when it's closed
+    tqdm_output = f"\r{line}\r{line}\n".split("|")
     progress = f"`[{tqdm_output[1]}]`"
     detail = tqdm_output[2].replace("[A", "")
     text = f"""
@@ -99,7 +213,6 @@ def tqdm_progress(desc, total, finished, speed="", eta=""):
 {more("Speed:", speed)}
 {more("ETA:", eta)}
     """
-    f.close()
     return text
 
 
@@ -123,19 +236,17 @@ def download_hook(d: dict, bot_msg):
             msg = f"Your download file size {sizeof_fmt(total)} is too large for Telegram."
             if PREMIUM_USER:
                 raise FileTooBig(msg)
-            else:
+            elif not SPLIT_LARGE_VIDEO:
                 raise Exception(msg)
 
         # percent = remove_bash_color(d.get("_percent_str", "N/A"))
         speed = remove_bash_color(d.get("_speed_str", "N/A"))
         eta = remove_bash_color(d.get("_eta_str", d.get("eta")))
-        text = tqdm_progress("Downloading...", total, downloaded, speed, eta)
-        edit_text(bot_msg, text)
+        edit_text(bot_msg, functools.partial(tqdm_progress, "Downloading...", total, downloaded, speed, eta))
 
 
 def upload_hook(current, total, bot_msg):
-    text = tqdm_progress("Uploading...", total, current)
-    edit_text(bot_msg, text)
+    edit_text(bot_msg, functools.partial(tqdm_progress, "Uploading...", total, current))
 
 
 def convert_to_mp4(video_paths: list, bot_msg):
@@ -143,7 +254,7 @@ def convert_to_mp4(video_paths: list, bot_msg):
     # all_converted = []
     for path in video_paths:
         # if we can't guess file type, we assume it's video/mp4
-        mime = getattr(filetype.guess(path), "mime", "video/mp4")
+        mime = guess_mime(path) or "video/mp4"
         if mime in default_type:
             if not can_convert_mp4(path, bot_msg.chat.id):
                 logging.warning("Conversion abort for %s", bot_msg.chat.id)
@@ -151,12 +262,29 @@ def convert_to_mp4(video_paths: list, bot_msg):
                 break
             edit_text(bot_msg, f"{current_time()}: Converting {path.name} to mp4. Please wait.")
             new_file_path = path.with_suffix(".mp4")
-            logging.info("Detected %s, converting to mp4...", mime)
-            run_ffmpeg_progressbar(["ffmpeg", "-y", "-i", path, new_file_path], bot_msg)
+            codec_args = mp4_codec_args(path)
+            logging.info("Detected %s, converting to mp4 with %s", mime, codec_args)
+            code = run_ffmpeg_progressbar(["ffmpeg", "-y", "-i", path, *codec_args, new_file_path], bot_msg)
+            if code != 0 and codec_args:
+                logging.warning("Remux failed for %s, falling back to full transcode", path)
+                run_ffmpeg_progressbar(["ffmpeg", "-y", "-i", path, new_file_path], bot_msg)
             index = video_paths.index(path)
             video_paths[index] = new_file_path
 
 
+def mp4_codec_args(path) -> list:
+    # copy the streams mp4 can hold (and Telegram can stream), re-encode only the one that doesn't fit.
+    # empty list means ffmpeg defaults, i.e. a full transcode
+    try:
+        streams = probe_media(path)["streams"]
+    except (ffmpeg.Error, OSError) as e:
+        logging.error("Failed to probe %s: %s", path, e)
+        return []
+    video = next((s["codec_name"] for s in streams if s["codec_type"] == "video"), None)
+    audio = next((s["codec_name"] for s in streams if s["codec_type"] == "audio"), None)
+    return ["-c:v", "copy" if video == "h264" else "libx264", "-c:a", "copy" if audio in ("aac", "mp3") else "aac"]
+
+
 class ProgressBar(tqdm):
     b = None
 
@@ -166,14 +294,15 @@ class ProgressBar(tqdm):
 
     def update(self, n=1):
         super().update(n)
-        t = tqdm_progress("Converting...", self.total, self.n)
-        edit_text(self.bot_msg, t)
+        edit_text(self.bot_msg, functools.partial(tqdm_progress, "Converting...", self.total, self.n))
 
 
 def run_ffmpeg_progressbar(cmd_list: list, bm):
     cmd_list = cmd_list.copy()[1:]
-    ProgressBar.b = bm
-    ffpb.main(cmd_list, tqdm=ProgressBar)
+    # ffmpeg is CPU bound, running more of them than there are cores only makes every conversion slower
+    with span("convert"), ffmpeg_slots:
+        ProgressBar.b = bm
+        return ffpb.main(cmd_list, tqdm=ProgressBar)
 
 
 def can_convert_mp4(video_path, uid):
@@ -182,8 +311,66 @@ def can_convert_mp4(video_path, uid):
     return True
 
 
+def info_cache_key(url: str, address: str = None) -> str:
+    # format urls are often signed for the IP that extracted them (YouTube's ip= parameter),
+    # so an info dict is only shared between the processes of one host and source address
+    return f"{socket.gethostname()}/{address or 'default'}/{url}"
+
+
+def fetch_info(url: str, ydl: ytdl.YoutubeDL = None, fresh: bool = False) -> tuple:
+    # extraction is the slowest part and YouTube throttles us, so the result is shared via redis.
+    # process=False keeps the raw info dict, process_ie_result will select the format later.
+    # returns the info dict and whether it came from the cache
+    redis = Redis()
+    ydl = ydl or ytdl.YoutubeDL({"quiet": True})
+    key = info_cache_key(url, ydl.params.get("source_address"))
+    if not fresh and (info := redis.get_info_cache(key)):
+        logging.info("Info cache hit for %s", url)
+        CACHE_REQUESTS.labels("info", "hit").inc()
+        add_tags(extractor=info.get("extractor_key"))
+        return info, True
+
+    CACHE_REQUESTS.labels("info", "miss").inc()
+    with span("extract"):
+        info = ydl.extract_info(url, download=False, process=False)
+    add_tags(extractor=info.get("extractor_key"))
+    # playlist entries are lazy, only single video is cached
+    if info.get("_type", "video") == "video":
+        redis.add_info_cache(key, ydl.sanitize_info(info))
+    return info, False
+
+
+def extract_info(url: str, ydl: ytdl.YoutubeDL = None) -> dict:
+    return fetch_info(url, ydl)[0]
+
+
+def prefetch_info(url: str, ydl_opts: dict, address: list) -> dict:
+    # format doesn't matter for extraction, so a broken link fails here once, not once per format
+    error = None
+    for addr in address:
+        try:
+            return extract_info(url, ytdl.YoutubeDL({**ydl_opts, "source_address": addr}))
+        except Exception as e:
+            error = e
+            logging.error("Extraction failed for %s with source address %s", url, addr)
+    raise error
+
+
+def match_format(info: dict, ydl_opts: dict) -> bool:
+    # format selection only reads the info dict, so trying a selector costs no network round trip
+    if ydl_opts.get("format") is None or info.get("_type", "video") != "video":
+        return True
+    with ytdl.YoutubeDL(ydl_opts) as ydl:
+        try:
+            ydl.process_ie_result(copy.deepcopy(info), download=False)
+            return True
+        except ytdl.utils.YoutubeDLError:
+            return False
+
+
 def ytdl_download(url: str, tempdir: str, bm, **kwargs) -> list:
     payment = Payment()
+    redis = Redis()
     chat_id = bm.chat.id
     hijack = kwargs.get("hijack")
     output = pathlib.Path(tempdir, "%(title).70s.%(ext)s").as_posix()
@@ -214,32 +401,54 @@ def ytdl_download(url: str, tempdir: str, bm, **kwargs) -> list:
         ]
     adjust_formats(chat_id, url, formats, hijack)
     if download_instagram(url, tempdir):
-        return list(pathlib.Path(tempdir).glob("*"))
+        # keep the carousel order
+        return sorted(pathlib.Path(tempdir).glob("*"))
 
-    address = ["::", "0.0.0.0"] if IPv6 else [None]
+    address = SOURCE_ADDRESSES
     error = None
     video_paths = None
+    info = prefetch_info(url, ydl_opts, address)
+    # checked here rather than in link_checker, the format loop below reuses this extraction
+    if info.get("live_status") == "is_live":
+        raise Exception("Live stream links are disabled. Please download it after the stream ends.")
     for format_ in formats:
         ydl_opts["format"] = format_
+        if LOCAL_FORMAT_SELECTION and not match_format(info, ydl_opts):
+            logging.info("Format %s is not available for %s, skipping", format_, url)
+            error = error or f"Requested format is not available for {url}"
+            continue
         for addr in address:
             # IPv6 goes first in each format
             ydl_opts["source_address"] = addr
-            try:
-                logging.info("Downloading for %s with format %s", url, format_)
-                with ytdl.YoutubeDL(ydl_opts) as ydl:
-                    ydl.download([url])
-                video_paths = list(pathlib.Path(tempdir).glob("*"))
+            for fresh in (False, True):
+                cached = False
+                try:
+                    logging.info("Downloading for %s with format %s", url, format_)
+                    with ytdl.YoutubeDL(ydl_opts) as ydl:
+                        ie_result, cached = fetch_info(url, ydl, fresh)
+                        with span("download", format=format_) as tags:
+                            ydl.process_ie_result(ie_result, download=True)
+                            video_paths = list(pathlib.Path(tempdir).glob("*"))
+                            tags["bytes"] = sum(path.stat().st_size for path in video_paths)
+                    break
+                except FileTooBig as e:
+                    raise e
+                except Exception:
+                    error = traceback.format_exc()
+                    redis.del_info_cache(info_cache_key(url, addr))
+                    if not cached:
+                        logging.error("Download failed for %s - %s, try another way", format_, url)
+                        break
+                    # the cached format urls may have expired, the same format gets one more try with a new extraction
+                    logging.warning("Download failed for %s - %s with cached info, extracting again", format_, url)
+            if video_paths:
                 break
-            except FileTooBig as e:
-                raise e
-            except Exception:
-                error = traceback.format_exc()
-                logging.error("Download failed for %s - %s, try another way", format_, url)
-        if error is None:
+        if video_paths:
             break
 
     if not video_paths:
         raise Exception(error)
+    TRANSFER_BYTES.labels("download").inc(sum(path.stat().st_size for path in video_paths))
 
     # convert format if necessary
     settings = payment.get_user_settings(chat_id)
@@ -248,7 +457,8 @@ def ytdl_download(url: str, tempdir: str, bm, **kwargs) -> list:
         convert_to_mp4(video_paths, bm)
     if settings[2] == "audio" or hijack == "bestaudio[ext=m4a]":
         convert_audio_format(video_paths, bm)
-    # split_large_video(video_paths)
+    if SPLIT_LARGE_VIDEO:
+        split_large_video(video_paths, bm)
     return video_paths
 
 
@@ -258,7 +468,7 @@ def convert_audio_format(video_paths: list, bm):
     # 3. non default format
 
     for path in video_paths:
-        streams = ffmpeg.probe(path)["streams"]
+        streams = probe_media(path)["streams"]
         if AUDIO_FORMAT is None and len(streams) == 1 and streams[0]["codec_type"] == "audio":
             logging.info("%s is audio, default format, no need to convert", path)
         elif AUDIO_FORMAT is None and len(streams) >= 2:
@@ -283,32 +493,373 @@ def convert_audio_format(video_paths: list, bm):
             video_paths[index] = new_path
 
 
-def split_large_video(video_paths: list):
-    original_video = None
-    split = False
-    for original_video in video_paths:
-        size = os.stat(original_video).st_size
-        if size > TG_NORMAL_MAX_SIZE:
-            split = True
-            logging.warning("file is too large %s, splitting...", size)
-            subprocess.check_output(f"sh split-video.sh {original_video} {TG_NORMAL_MAX_SIZE * 0.95} ".split())
-            os.remove(original_video)
-
-    if split and original_video:
-        return [i for i in pathlib.Path(original_video).parent.glob("*")]
+def keyframe_cuts(path: pathlib.Path, limit: int) -> list:
+    # pick cut points from the packet sizes, at keyframes so that stream copy can cut there.
+    # ffprobe only reads the packets, nothing gets decoded
+    probe = probe_media(path)
+    streams = probe["streams"]
+    # the segment muxer compares against output timestamps, which ffmpeg shifts to start at 0
+    start = float(probe["format"].get("start_time", 0))
+    index = next((s["index"] for s in streams if s["codec_type"] == "video"), streams[0]["index"])
+    cmd = ["ffprobe", "-v", "error", "-show_entries", "packet=stream_index,pts_time,size,flags", "-of", "compact=p=0"]
+    cuts, part_size, keyframe = [], 0, None
+    with subprocess.Popen([*cmd, path], stdout=subprocess.PIPE, text=True) as proc:
+        for line in proc.stdout:
+            packet = dict(item.split("=", 1) for item in line.strip().split("|") if "=" in item)
+            if "size" not in packet:
+                # blank line after a packet with side data
+                continue
+            if int(packet["stream_index"]) == index and packet["flags"].startswith("K") and packet["pts_time"] != "N/A":
+                keyframe = (packet["pts_time"], part_size)
+            part_size += int(packet["size"])
+            if part_size > limit and keyframe and keyframe[1]:
+                cuts.append(f"{float(keyframe[0]) - start:.6f}")
+                part_size -= keyframe[1]
+                keyframe = None
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+    return cuts
+
+
+def split_large_video(video_paths: list, bm):
+    # keep some room for the container overhead of each part
+    limit = int(TG_NORMAL_MAX_SIZE * 0.95)
+    for path in video_paths.copy():
+        size = path.stat().st_size
+        if size <= TG_NORMAL_MAX_SIZE:
+            continue
+        logging.warning("file is too large %s, splitting...", size)
+        cuts = keyframe_cuts(path, limit)
+        if not cuts:
+            # a single GOP larger than the limit, stream copy can't cut it
+            raise Exception(f"{path.name} has no keyframe to split it at, it's too large for Telegram")
+        # one pass, stream copy. The segment muxer cuts at the keyframes found above
+        template = path.with_name(f"{path.stem.replace('%', '%%')}-%03d{path.suffix}")
+        segment = ["-f", "segment", "-segment_times", ",".join(cuts), "-reset_timestamps", "1"]
+        code = run_ffmpeg_progressbar(["ffmpeg", "-y", "-i", path, "-c", "copy", *segment, template], bm)
+        parts = sorted(path.parent.glob(f"{glob.escape(path.stem)}-[0-9][0-9][0-9]{path.suffix}"))
+        if code != 0 or not parts:
+            # the original is only removed once every part is complete
+            for part in parts:
+                part.unlink(missing_ok=True)
+            raise Exception(f"Failed to split {path.name}, ffmpeg exited with {code}")
+        if large := [part for part in parts if part.stat().st_size > TG_NORMAL_MAX_SIZE]:
+            # keyframes too far apart, a part can't be smaller than the distance between two of them
+            sizes = ", ".join(f"{part.name} {sizeof_fmt(part.stat().st_size)}" for part in large)
+            for part in parts:
+                part.unlink(missing_ok=True)
+            raise Exception(f"Failed to split {path.name} into parts small enough for Telegram: {sizes}")
+        path.unlink()
+        index = video_paths.index(path)
+        video_paths[index : index + 1] = parts
+
+
+def download_thumbnail(url: str, clink: str) -> str | None:
+    # the thumbnail yt-dlp already knows is a lot cheaper than seeking and decoding a frame of the video
+    path = THUMBNAIL_PATH.joinpath(f"{hashlib.sha1(clink.encode()).hexdigest()}.jpg")
+    if path.exists():
+        return path.as_posix()
+
+    redis = Redis()
+    info = next(filter(None, (redis.get_info_cache(info_cache_key(url, addr)) for addr in SOURCE_ADDRESSES)), {})
+    for link in thumbnail_candidates(info)[:3]:
+        try:
+            r = requests.get(link, timeout=10)
+            r.raise_for_status()
+            image = Image.open(BytesIO(r.content)).convert("RGB")
+            # telegram wants a jpeg thumbnail no larger than 320x320
+            image.thumbnail((320, 320))
+            THUMBNAIL_PATH.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_suffix(f".{uuid.uuid4().hex}")
+            image.save(tmp, "JPEG", quality=85)
+            os.replace(tmp, path)
+            return path.as_posix()
+        except Exception as e:
+            logging.warning("Failed to download thumbnail %s: %s", link, e)
+
+
+def thumbnail_candidates(info: dict) -> list:
+    # raw info isn't processed, so the thumbnail list is in the extractor's order, not sorted like yt-dlp does.
+    # the one yt-dlp picked goes first, then the rest from the best down
+    thumbnails = sorted(
+        info.get("thumbnails") or [],
+        key=lambda t: (t.get("preference") or 0, t.get("width") or 0, t.get("height") or 0),
+        reverse=True,
+    )
+    links = [info.get("thumbnail")] + [t.get("url") for t in thumbnails]
+    return list(dict.fromkeys(link for link in links if link))
+
+
+def fetch_instagram_media(index: int, link: str, tempdir: str):
+    # stream to disk, only the first bytes are kept in memory for type sniffing
+    with instagram_session.get(link, stream=True, timeout=30) as r:
+        r.raise_for_status()
+        chunks = r.iter_content(1024 * 1024)
+        head = b""
+        for chunk in chunks:
+            head += chunk
+            # filetype needs 261 bytes at most to tell the type
+            if len(head) >= 261:
+                break
+        ext = filetype.guess_extension(head)
+        save_path = pathlib.Path(tempdir, f"{index:02d}.{ext}")
+        with open(save_path, "wb") as f:
+            f.write(head)
+            for chunk in chunks:
+                f.write(chunk)
 
 
 def download_instagram(url: str, tempdir: str):
     if not url.startswith("https://www.instagram.com"):
         return False
 
-    resp = requests.get(f"http://192.168.6.1:15000/?url={url}").json()
+    resp = instagram_session.get(f"http://192.168.6.1:15000/?url={url}").json()
     if url_results := resp.get("data"):
-        for link in url_results:
-            content = requests.get(link, stream=True).content
-            ext = filetype.guess_extension(content)
-            save_path = pathlib.Path(tempdir, f"{id(link)}.{ext}")
-            with open(save_path, "wb") as f:
-                f.write(content)
+        # carousel items are fetched concurrently over the keep-alive connections of one session
+        add_tags(extractor="Instagram")
+        with span("download") as tags:
+            with concurrent.futures.ThreadPoolExecutor(min(len(url_results), 8)) as pool:
+                futures = [pool.submit(fetch_instagram_media, i, link, tempdir) for i, link in enumerate(url_results)]
+                for future in futures:
+                    future.result()
+            tags["bytes"] = sum(path.stat().st_size for path in pathlib.Path(tempdir).glob("*"))
+        TRANSFER_BYTES.labels("download").inc(tags["bytes"])
 
         return True
+
+
+def accepts_ranges(url: str, headers: dict) -> bool:
+    # some servers advertise Accept-Ranges but answer every range request with the whole file
+    try:
+        with requests.get(url, headers={**headers, "Range": "bytes=0-0"}, stream=True, timeout=30) as r:
+            return r.status_code == 206
+    except requests.RequestException as e:
+        logging.warning("Range probe of %s failed: %s", url, e)
+        return False
+
+
+def ranged_download(url: str, headers: dict, length: int, filepath: str, bot_msg):
+    # several connections for CDNs that cap the bandwidth of each one.
+    # progress is kept in a sidecar state file, so the same file can be resumed after a worker restart.
+    state_path = f"{filepath}.state"
+    state = {}
+    with contextlib.suppress(FileNotFoundError, ValueError):
+        state = json.loads(pathlib.Path(state_path).read_text())
+    if state.get("url") == url and state.get("length") == length and os.path.exists(filepath):
+        # [start, end, position] of each range
+        ranges = state["ranges"]
+        logging.info("Resuming %s from %s", url, state_path)
+    else:
+        size = max(math.ceil(length / (DIRECT_CONNECTIONS * 4)), 1024 * 1024)
+        ranges = [[start, min(start + size, length) - 1, start] for start in range(0, length, size)]
+
+    fd = os.open(filepath, os.O_RDWR | os.O_CREAT)
+    try:
+        os.posix_fallocate(fd, 0, length)
+    except (AttributeError, OSError):
+        os.ftruncate(fd, length)
+
+    lock = threading.Lock()
+    downloaded = sum(position - start for start, _, position in ranges)
+    saved_at = time.time()
+
+    def save_state():
+        tmp = f"{state_path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"url": url, "length": length, "ranges": ranges}, f)
+        os.replace(tmp, state_path)
+
+    def fetch(range_: list):
+        nonlocal downloaded, saved_at
+        end = range_[1]
+        for attempt in range(5):
+            if range_[2] > end:
+                return
+            try:
+                range_header = {**headers, "Range": f"bytes={range_[2]}-{end}"}
+                with requests.get(url, headers=range_header, stream=True, timeout=30) as r:
+                    if r.status_code != 206:
+                        raise ValueError(f"Range request returned {r.status_code}")
+                    for chunk in r.iter_content(1024 * 1024):
+                        chunk = chunk[: end + 1 - range_[2]]
+                        os.pwrite(fd, chunk, range_[2])
+                        with lock:
+                            range_[2] += len(chunk)
+                            downloaded += len(chunk)
+                            if time.time() - saved_at > 2:
+                                save_state()
+                                saved_at = time.time()
+                        edit_text(bot_msg, functools.partial(tqdm_progress, "Downloading...", length, downloaded))
+                        if range_[2] > end:
+                            return
+            except Exception as e:
+                logging.warning("Range %s-%s of %s failed: %s, retrying...", range_[2], end, url, e)
+                time.sleep(2**attempt)
+        raise Exception(f"Failed to download range {range_[0]}-{end} of {url}")
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(DIRECT_CONNECTIONS) as pool:
+            list(pool.map(fetch, ranges))
+    finally:
+        with lock:
+            save_state()
+        os.close(fd)
+    os.remove(state_path)
+
+
+class PartBuffer:
+    """
+    FIFO of telegram file parts between the http download and the upload threads.
+    Parts are kept in memory up to max_parts, then spill to a small temp file, and only then the download blocks.
+    """
+
+    def __init__(self, max_parts: int, spill_size: int):
+        self.max_parts = max_parts
+        self.spill_size = spill_size
+        # each item is either the part itself or (offset, length) in the spill file
+        self.parts = collections.deque()
+        self.in_memory = 0
+        self.spilled = 0
+        self.spill_pos = 0
+        self.spill = tempfile.TemporaryFile(prefix="ytdl-", dir=TMPFILE_PATH)
+        self.index = 0
+        self.closed = False
+        self.error = None
+        self.cond = threading.Condition()
+
+    def put(self, part: bytes):
+        with self.cond:
+            while True:
+                if self.error:
+                    raise self.error
+                if self.in_memory < self.max_parts:
+                    self.parts.append(part)
+                    self.in_memory += 1
+                    break
+                if self.spill_pos + len(part) <= self.spill_size:
+                    self.spill.seek(self.spill_pos)
+                    self.spill.write(part)
+                    self.parts.append((self.spill_pos, len(part)))
+                    self.spill_pos += len(part)
+                    self.spilled += 1
+                    break
+                self.cond.wait()
+            self.cond.notify_all()
+
+    def get(self) -> tuple | None:
+        # returns (part index, part), None once the download is finished and everything has been taken
+        with self.cond:
+            self.cond.wait_for(lambda: self.parts or self.closed or self.error)
+            if self.error or not self.parts:
+                return None
+            item = self.parts.popleft()
+            if isinstance(item, bytes):
+                part = item
+                self.in_memory -= 1
+            else:
+                offset, length = item
+                self.spill.seek(offset)
+                part = self.spill.read(length)
+                self.spilled -= 1
+                if self.spilled == 0:
+                    # spill file is drained, reuse it from the beginning
+                    self.spill_pos = 0
+            index = self.index
+            self.index += 1
+            self.cond.notify_all()
+            return index, part
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def abort(self, error: Exception):
+        with self.cond:
+            self.error = self.error or error
+            self.cond.notify_all()
+
+    def cleanup(self):
+        self.spill.close()
+
+
+def stream_upload(client, bot_msg, req: requests.Response, length: int, filename: str):
+    # upload telegram file parts while the http download is still running, so the file never hits the disk
+    part_size = 512 * 1024
+    total_parts = math.ceil(length / part_size)
+    file_id = client.rnd_id()
+    buffer = PartBuffer(STREAM_BUFFER, STREAM_SPILL_SIZE)
+    lock = threading.Lock()
+    uploaded = 0
+
+    def upload():
+        nonlocal uploaded
+        while part := buffer.get():
+            index, chunk = part
+            rpc = raw.functions.upload.SaveBigFilePart(
+                file_id=file_id, file_part=index, file_total_parts=total_parts, bytes=chunk
+            )
+            error = None
+            for _ in range(3):
+                try:
+                    if client.invoke(rpc):
+                        break
+                    error = IOError(f"Telegram rejected part {index} of {filename}")
+                except pyrogram.errors.FloodWait as e:
+                    logging.warning("FloodWait %s seconds for part %s of %s", e.value, index, filename)
+                    FLOOD_WAITS.labels("upload").inc()
+                    error = e
+                    time.sleep(e.value)
+                    continue
+                except Exception as e:
+                    error = e
+                logging.error("Failed to upload part %s of %s: %s", index, filename, error)
+            else:
+                buffer.abort(error)
+                return
+            with lock:
+                uploaded += len(chunk)
+                edit_text(bot_msg, functools.partial(tqdm_progress, "Downloading & uploading...", length, uploaded))
+
+    workers = [threading.Thread(target=upload, daemon=True) for _ in range(4)]
+    for worker in workers:
+        worker.start()
+
+    downloaded = 0
+    pending = bytearray()
+    try:
+        for chunk in req.iter_content(part_size):
+            downloaded += len(chunk)
+            pending += chunk
+            while len(pending) >= part_size:
+                buffer.put(bytes(pending[:part_size]))
+                del pending[:part_size]
+        if pending:
+            buffer.put(bytes(pending))
+        if downloaded != length:
+            raise ValueError(f"Expected {length} bytes but got {downloaded} bytes")
+    except Exception as e:
+        buffer.abort(e)
+        raise
+    finally:
+        buffer.close()
+        for worker in workers:
+            worker.join()
+        buffer.cleanup()
+
+    if buffer.error:
+        raise buffer.error
+
+    logging.info("Streamed file %s, %s parts uploaded", filename, total_parts)
+    client.invoke(
+        raw.functions.messages.SendMedia(
+            peer=client.resolve_peer(bot_msg.chat.id),
+            media=raw.types.InputMediaUploadedDocument(
+                file=raw.types.InputFileBig(id=file_id, parts=total_parts, name=filename),
+                mime_type=client.guess_mime_type(filename) or "application/zip",
+                attributes=[raw.types.DocumentAttributeFilename(file_name=filename)],
+            ),
+            message=f"filesize: {sizeof_fmt(length)}",
+            random_id=client.rnd_id(),
+        )
+    )
@@ -1,15 +1,36 @@
-from flask import Flask
+import os
+import socket
 from threading import Thread
 
+from flask import Flask, Response
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
 app = Flask('')
 
+WORKER_NAME = os.getenv("WORKER_NAME") or socket.gethostname()
+# seconds spent in extract, download, convert, metadata and upload
+STAGE_SECONDS = Histogram(
+    "ytdl_stage_seconds",
+    "Time spent in each stage of a task",
+    ["stage"],
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600),
+)
+TRANSFER_BYTES = Counter("ytdl_transfer_bytes", "Bytes downloaded from the source and uploaded to Telegram", ["direction"])
+CACHE_REQUESTS = Counter("ytdl_cache_requests", "Cache lookups", ["cache", "result"])
+FLOOD_WAITS = Counter("ytdl_flood_waits", "FloodWait errors from Telegram", ["source"])
+TASKS_IN_FLIGHT = Gauge("ytdl_tasks_in_flight", "Tasks being processed right now", ["worker", "kind"])
+
 @app.route('/')
 def home():
     return "Hello. I am alive!"
 
+@app.route('/metrics')
+def metrics():
+    return Response(generate_latest(), content_type=CONTENT_TYPE_LATEST)
+
 def run():
   app.run(host='0.0.0.0',port=8080)
 
 def keep_alive():
-    t = Thread(target=run)
+    t = Thread(target=run, daemon=True)
     t.start()
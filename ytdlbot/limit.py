@@ -2,6 +2,7 @@
 
 import hashlib
 import logging
+import threading
 import time
 
 import requests
@@ -18,6 +19,7 @@ from config import (
     EXPIRE,
     FREE_DOWNLOAD,
     OWNER,
+    PROFILE_EXPIRE,
     TOKEN_PRICE,
     TRON_MNEMONIC,
     TRONGRID_KEY,
@@ -28,6 +30,20 @@ from utils import apply_log_formatter, current_time
 
 apply_log_formatter()
 
+# check and use a free token in one step. A missing key means the daily tokens haven't been touched yet
+FREE_TOKEN_SCRIPT = """
+local token = redis.call("GET", KEYS[1])
+if not token then
+    token = ARGV[1]
+    redis.call("SET", KEYS[1], token, "EX", ARGV[2])
+end
+if tonumber(token) > 0 then
+    redis.call("DECR", KEYS[1])
+    return 1
+end
+return 0
+"""
+
 
 class BuyMeACoffee:
     def __init__(self):
@@ -172,6 +188,41 @@ class TronTrx:
 
 
 class Payment(Redis, MySQL):
+    # user_id: (expire time, profile). One download used to read the same settings from mysql over and over
+    profiles = {}
+    profiles_lock = threading.Lock()
+
+    def get_profile(self, user_id: int) -> dict:
+        entry = self.profiles.get(user_id)
+        if entry and entry[0] > time.time():
+            return entry[1]
+        profile = {
+            "settings": super().get_user_settings(user_id),
+            "free": self.get_free_token(user_id),
+            "pay": self.get_pay_token(user_id),
+            "ban": bool(self.r.hget("ban", user_id)),
+            "premium_used": bool(self.r.hget("premium", user_id)),
+        }
+        now = time.time()
+        with self.profiles_lock:
+            # every entry has the same ttl, so re-inserting at the end keeps the dict in expiry order
+            self.profiles.pop(user_id, None)
+            self.profiles[user_id] = (now + PROFILE_EXPIRE, profile)
+            while (oldest := next(iter(self.profiles))) != user_id and self.profiles[oldest][0] <= now:
+                del self.profiles[oldest]
+        return profile
+
+    def invalidate_profile(self, user_id: int):
+        with self.profiles_lock:
+            self.profiles.pop(user_id, None)
+
+    def get_user_settings(self, user_id: int) -> tuple:
+        return self.get_profile(user_id)["settings"]
+
+    def set_user_settings(self, user_id: int, field: str, value: str):
+        super().set_user_settings(user_id, field, value)
+        self.invalidate_profile(user_id)
+
     def check_old_user(self, user_id: int) -> tuple:
         self.cur.execute("SELECT * FROM payment WHERE user_id=%s AND old_user=1", (user_id,))
         data = self.cur.fetchone()
@@ -200,33 +251,29 @@ class Payment(Redis, MySQL):
         ttl = self.r.ttl(user_id)
         return self.get_free_token(user_id), self.get_pay_token(user_id), current_time(time.time() + ttl)
 
-    def use_free_token(self, user_id: int):
-        if self.r.exists(user_id):
-            self.r.decr(user_id, 1)
-        else:
-            # first time download
-            self.r.set(user_id, 5 - 1, ex=EXPIRE)
+    def use_free_token(self, user_id: int) -> bool:
+        return bool(self.r.register_script(FREE_TOKEN_SCRIPT)(keys=[user_id], args=[FREE_DOWNLOAD, EXPIRE]))
 
-    def use_pay_token(self, user_id: int):
-        # a user may pay multiple times, so we'll need to filter the first payment with valid token
-        self.cur.execute("SELECT payment_id FROM payment WHERE user_id=%s AND token>0", (user_id,))
-        data = self.cur.fetchone()
-        payment_id = data[0]
-        logging.info("User %s use pay token with payment_id %s", user_id, payment_id)
-        self.cur.execute("UPDATE payment SET token=token-1 WHERE payment_id=%s", (payment_id,))
+    def use_pay_token(self, user_id: int) -> bool:
+        # a user may pay multiple times, only one payment with valid token is charged
+        affected = self.cur.execute("UPDATE payment SET token=token-1 WHERE user_id=%s AND token>0 LIMIT 1", (user_id,))
         self.con.commit()
+        return bool(affected)
 
-    def use_token(self, user_id: int):
-        free = self.get_free_token(user_id)
-        if free > 0:
-            self.use_free_token(user_id)
+    def use_token(self, user_id: int) -> bool:
+        # check and consume together, two requests at the same time can't both spend the last token
+        used = self.use_free_token(user_id) or self.use_pay_token(user_id)
+        if used:
+            self.invalidate_profile(user_id)
         else:
-            self.use_pay_token(user_id)
+            logging.info("User %s has no token left", user_id)
+        return used
 
     def add_pay_user(self, pay_data: list):
         self.cur.execute("INSERT INTO payment VALUES (%s,%s,%s,%s,%s)", pay_data)
         self.set_user_settings(pay_data[0], "mode", "Local")
         self.con.commit()
+        self.invalidate_profile(pay_data[0])
 
     def verify_payment(self, user_id: int, unique: str) -> str:
         pay = BuyMeACoffee() if "@" in unique else Afdian()
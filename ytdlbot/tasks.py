@@ -1,5 +1,9 @@
 
 import asyncio
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
 import logging
 import os
 import pathlib
@@ -13,41 +17,69 @@ import traceback
 import typing
 from typing import Any
 from urllib.parse import quote_plus
-from keep_alive import keep_alive 
+from keep_alive import (
+    CACHE_REQUESTS,
+    FLOOD_WAITS,
+    TASKS_IN_FLIGHT,
+    TRANSFER_BYTES,
+    WORKER_NAME,
+    keep_alive,
+)
 
-import filetype
 import psutil
 import pyrogram.errors
 import requests
 from apscheduler.schedulers.background import BackgroundScheduler
 from celery import Celery
 from celery.worker.control import Panel
-from pyrogram import Client, enums, idle, types
+from pyrogram import Client, enums, idle, raw, types
+from pyrogram.file_id import FileId, FileType, ThumbnailSource
 
 from channel import Channel
 from client_init import create_app
 from config import (
     ARCHIVE_ID,
     BROKER,
+    CELERY_QUEUES,
+    DIRECT_CONNECTIONS,
+    DIRECT_STREAMING,
+    DIRECT_WORKERS,
+    DOWNLOAD_WORKERS,
     ENABLE_CELERY,
     ENABLE_VIP,
+    FLIGHT_RETRIES,
     OWNER,
     RATE_LIMIT,
     RCLONE_PATH,
     TMPFILE_PATH,
-    WORKERS,
+    TRANSCODE_WORKERS,
     FileTooBig,
 )
 from constant import BotText
 from database import Redis
-from downloader import edit_text, tqdm_progress, upload_hook, ytdl_download
+from downloader import (
+    accepts_ranges,
+    download_thumbnail,
+    edit_text,
+    flush_text,
+    ranged_download,
+    stream_upload,
+    tqdm_progress,
+    upload_hook,
+    ytdl_download,
+)
 from limit import Payment
+from tracing import span, traced
 from utils import (
     apply_log_formatter,
     auto_restart,
+    clean_tempfile,
+    clean_thumbnail,
     customize_logger,
+    directory_lock,
     get_metadata,
     get_revision,
+    guess_mime,
     sizeof_fmt,
 )
 
@@ -56,7 +88,17 @@ apply_log_formatter()
 bot_text = BotText()
 logging.getLogger("apscheduler.executors.default").propagate = False
 
-app = Celery("tasks", broker=BROKER)
+QUEUE_CONCURRENCY = {"download": DOWNLOAD_WORKERS, "transcode": TRANSCODE_WORKERS, "direct": DIRECT_WORKERS}
+
+
+def create_celery() -> Celery:
+    celery_app = Celery("tasks", broker=BROKER)
+    # a thread only takes the next task when it's free, so one worker can't hoard tasks another could run
+    celery_app.conf.worker_prefetch_multiplier = 1
+    return celery_app
+
+
+app = create_celery()
 bot = create_app("tasks")
 channel = Channel()
 
@@ -72,17 +114,12 @@ def retrieve_message(chat_id: int, message_id: int) -> types.Message | Any:
 
 
 def premium_button(user_id):
-    redis = Redis()
-    payment = Payment()
-    used = redis.r.hget("premium", user_id)
-    ban = redis.r.hget("ban", user_id)
-    paid_token = payment.get_pay_token(user_id)
-
-    if ban:
+    profile = Payment().get_profile(user_id)
+    if profile["ban"]:
         return None
     # vip mode: vip user can use once per day, normal user can't use
     # non vip mode: everyone can use once per day
-    if used or (ENABLE_VIP and paid_token == 0):
+    if profile["premium_used"] or (ENABLE_VIP and profile["pay"] == 0):
         return None
 
     markup = types.InlineKeyboardMarkup(
@@ -96,30 +133,36 @@ def premium_button(user_id):
     return markup
 
 
-@app.task(rate_limit=f"{RATE_LIMIT}/m")
-def ytdl_download_task(chat_id: int, message_id: int, url: str):
+@app.task(rate_limit=f"{RATE_LIMIT}/m", queue="download")
+def ytdl_download_task(chat_id: int, message_id: int, url: str, unique: str = None, attempt: int = 0):
     logging.info("YouTube celery tasks started for %s", url)
     bot_msg = retrieve_message(chat_id, message_id)
     try:
-        ytdl_normal_download(bot, bot_msg, url)
+        ytdl_normal_download(bot, bot_msg, url, unique)
     except FileTooBig as e:
         # if you can go there, that means you have premium users set up
         logging.warning("Seeking for help from premium user...")
         markup = premium_button(chat_id)
         if markup:
-            bot_msg.edit_text(f"{e}\n\n{bot_text.premium_warning}", reply_markup=markup)
+            flush_text(bot_msg, f"{e}\n\n{bot_text.premium_warning}", reply_markup=markup)
         else:
-            bot_msg.edit_text(f"{e}\nBig file download is not available now. Please /buy or try again later ")
+            flush_text(bot_msg, f"{e}\nBig file download is not available now. Please /buy or try again later ")
     except Exception:
         error_msg = traceback.format_exc().split("yt_dlp.utils.DownloadError: ERROR: ")
         if len(error_msg) > 1:
-            bot_msg.edit_text(f"Download failed!❌\n\n`{error_msg[-1]}", disable_web_page_preview=True)
+            flush_text(bot_msg, f"Download failed!❌\n\n`{error_msg[-1]}", disable_web_page_preview=True)
         else:
-            bot_msg.edit_text(f"Download failed!❌\n\n`{traceback.format_exc()[-2000:]}`", disable_web_page_preview=True)
+            flush_text(
+                bot_msg, f"Download failed!❌\n\n`{traceback.format_exc()[-2000:]}`", disable_web_page_preview=True
+            )
+    finally:
+        if unique:
+            # handed over by ytdl_download_entrance, the requests queued behind this link are served from here
+            land_flight(bot, unique, f"{chat_id}:{message_id}", attempt)
     logging.info("YouTube celery tasks ended.")
 
 
-@app.task()
+@app.task(queue="transcode")
 def audio_task(chat_id: int, message_id: int):
     logging.info("Audio celery tasks started for %s-%s", chat_id, message_id)
     bot_msg = retrieve_message(chat_id, message_id)
@@ -127,7 +170,7 @@ def audio_task(chat_id: int, message_id: int):
     logging.info("Audio celery tasks ended.")
 
 
-@app.task()
+@app.task(queue="direct")
 def direct_download_task(chat_id: int, message_id: int, url: str):
     logging.info("Direct download celery tasks started for %s", url)
     bot_msg = retrieve_message(chat_id, message_id)
@@ -138,7 +181,7 @@ def direct_download_task(chat_id: int, message_id: int, url: str):
 def get_unique_clink(original_url: str, user_id: int):
     payment = Payment()
     settings = payment.get_user_settings(user_id)
-    clink = channel.extract_canonical_link(original_url)
+    clink = channel.get_canonical_link(original_url)
     try:
         # different user may have different resolution settings
         unique = "{}?p={}{}".format(clink, *settings[1:])
@@ -147,16 +190,80 @@ def get_unique_clink(original_url: str, user_id: int):
     return unique
 
 
-def forward_video(client, bot_msg: types.Message | Any, url: str, cached_fid: str):
+def forward_video(client, bot_msg: types.Message | Any, url: str, cached_fid: str | list):
     res_msg = upload_processor(client, bot_msg, url, cached_fid)
     obj = res_msg.document or res_msg.video or res_msg.audio or res_msg.animation or res_msg.photo
 
     caption, _ = gen_cap(bot_msg, url, obj)
-    res_msg.edit_text(caption, reply_markup=gen_video_markup())
-    bot_msg.edit_text(f"Download success!✅")
+    # media groups can't have inline keyboards
+    markup = None if isinstance(cached_fid, list) else gen_video_markup()
+    res_msg.edit_text(caption, reply_markup=markup)
+    flush_text(bot_msg, f"Download success!✅")
     return True
 
 
+def land_flight(client: Client, unique: str, token: str, attempt: int = 0):
+    # called by the holder once its download is over. The queued requests of the link get its file id,
+    # or if it failed, the first of them downloads again for all of them, at most FLIGHT_RETRIES times
+    redis = Redis()
+    waiters = redis.release_flight(unique, token)
+    if not waiters:
+        return
+    cached_fid = redis.get_send_cache(unique)
+    if not cached_fid and attempt < FLIGHT_RETRIES:
+        first, *rest = waiters
+        retry_token = f"{first['chat_id']}:{first['message_id']}"
+        if redis.acquire_flight(unique, retry_token):
+            logging.warning("Download of %s failed, retrying for %s", unique, retry_token)
+            for waiter in rest:
+                redis.join_flight(unique, waiter)
+            retry_flight(client, first, unique, attempt + 1)
+            return
+        # another request has just started the link again, they go with that download
+        waiters = [waiter for waiter in waiters if not redis.join_flight(unique, waiter)]
+
+    for waiter in waiters:
+        # a popular link has many of them, sent in a burst
+        for _ in range(2):
+            try:
+                serve_waiter(client, waiter, cached_fid)
+                break
+            except pyrogram.errors.FloodWait as e:
+                logging.warning("FloodWait %s seconds while serving %s", e.value, waiter)
+                FLOOD_WAITS.labels("coalesced").inc()
+                time.sleep(e.value)
+            except Exception as e:
+                logging.error("Failed to serve %s queued for %s: %s", waiter, unique, e)
+                break
+
+
+def serve_waiter(client: Client, waiter: dict, cached_fid: str | list | None):
+    bot_msg = client.get_messages(waiter["chat_id"], waiter["message_id"])
+    if cached_fid:
+        forward_video(client, bot_msg, waiter["url"], cached_fid)
+        Redis().update_metrics("cache_coalesced")
+        CACHE_REQUESTS.labels("send", "coalesced").inc()
+    else:
+        flush_text(bot_msg, "Download failed!❌\n\nThe download of this link failed, please try again later.")
+
+
+def retry_flight(client: Client, waiter: dict, unique: str, attempt: int):
+    chat_id, message_id, url = waiter["chat_id"], waiter["message_id"], waiter["url"]
+    if ENABLE_CELERY and Payment().get_user_settings(chat_id)[-1] in [None, "Celery"]:
+        ytdl_download_task.delay(chat_id, message_id, url, unique, attempt)
+        return
+    bot_msg = None
+    try:
+        bot_msg = client.get_messages(chat_id, message_id)
+        ytdl_normal_download(client, bot_msg, url, unique)
+    except Exception as e:
+        logging.error("Failed to download %s, error: %s", url, e)
+        if bot_msg:
+            flush_text(bot_msg, f"Download failed!❌\n\n`{e}`", disable_web_page_preview=True)
+    finally:
+        land_flight(client, unique, f"{chat_id}:{message_id}", attempt)
+
+
 def ytdl_download_entrance(client: Client, bot_msg: types.Message, url: str, mode=None):
     # in Local node and forward mode, we pass client from main
     # in celery mode, we need to use our own client called bot
@@ -165,34 +272,55 @@ def ytdl_download_entrance(client: Client, bot_msg: types.Message, url: str, mod
     chat_id = bot_msg.chat.id
     unique = get_unique_clink(url, chat_id)
     cached_fid = redis.get_send_cache(unique)
+    token = f"{chat_id}:{bot_msg.id}"
+    holding = False
 
     try:
+        if not cached_fid:
+            holding = redis.acquire_flight(unique, token)
+        if not cached_fid and not holding:
+            waiter = {"chat_id": chat_id, "message_id": bot_msg.id, "url": url}
+            if redis.join_flight(unique, waiter):
+                # the same link is being downloaded for someone else right now, its holder forwards the file here
+                edit_text(bot_msg, "This link is being downloaded for another user, it will be sent once it's done.")
+                return
+            # the flight has just landed
+            cached_fid = redis.get_send_cache(unique)
+            holding = not cached_fid and redis.acquire_flight(unique, token)
         if cached_fid:
             forward_video(client, bot_msg, url, cached_fid)
             redis.update_metrics("cache_hit")
+            CACHE_REQUESTS.labels("send", "hit").inc()
             return
         redis.update_metrics("cache_miss")
+        CACHE_REQUESTS.labels("send", "miss").inc()
         mode = mode or payment.get_user_settings(chat_id)[-1]
         if ENABLE_CELERY and mode in [None, "Celery"]:
-            # in celery mode, producer has lost control of this task.
-            ytdl_download_task.delay(chat_id, bot_msg.id, url)
+            # in celery mode, producer has lost control of this task. The task lands the flight
+            ytdl_download_task.delay(chat_id, bot_msg.id, url, unique if holding else None)
+            holding = False
         else:
-            ytdl_normal_download(client, bot_msg, url)
+            ytdl_normal_download(client, bot_msg, url, unique)
     except FileTooBig as e:
         logging.warning("Seeking for help from premium user...")
         # this is only for normal node. Celery node will need to do it in celery tasks
         markup = premium_button(chat_id)
         if markup:
-            bot_msg.edit_text(f"{e}\n\n{bot_text.premium_warning}", reply_markup=markup)
+            flush_text(bot_msg, f"{e}\n\n{bot_text.premium_warning}", reply_markup=markup)
         else:
-            bot_msg.edit_text(f"{e}\nBig file download is not available now. Please /buy or try again later ")
+            flush_text(bot_msg, f"{e}\nBig file download is not available now. Please /buy or try again later ")
     except Exception as e:
         logging.error("Failed to download %s, error: %s", url, e)
         error_msg = traceback.format_exc().split("yt_dlp.utils.DownloadError: ERROR: ")
         if len(error_msg) > 1:
-            bot_msg.edit_text(f"Download failed!❌\n\n`{error_msg[-1]}", disable_web_page_preview=True)
+            flush_text(bot_msg, f"Download failed!❌\n\n`{error_msg[-1]}", disable_web_page_preview=True)
         else:
-            bot_msg.edit_text(f"Download failed!❌\n\n`{traceback.format_exc()[-2000:]}`", disable_web_page_preview=True)
+            flush_text(
+                bot_msg, f"Download failed!❌\n\n`{traceback.format_exc()[-2000:]}`", disable_web_page_preview=True
+            )
+    finally:
+        if holding:
+            land_flight(client, unique, token)
 
 
 def direct_download_entrance(client: Client, bot_msg: typing.Union[types.Message, typing.Coroutine], url: str):
@@ -210,6 +338,8 @@ def audio_entrance(client: Client, bot_msg: types.Message):
         normal_audio(client, bot_msg)
 
 
+@TASKS_IN_FLIGHT.labels(WORKER_NAME, "direct").track_inprogress()
+@traced("direct")
 def direct_normal_download(client: Client, bot_msg: typing.Union[types.Message, typing.Coroutine], url: str):
     chat_id = bot_msg.chat.id
     headers = {
@@ -225,36 +355,76 @@ def direct_normal_download(client: Client, bot_msg: typing.Union[types.Message,
     except TypeError:
         filename = getattr(req, "url", "").rsplit("/")[-1]
     except Exception as e:
-        bot_msg.edit_text(f"Download failed!❌\n\n```{e}```", disable_web_page_preview=True)
+        flush_text(bot_msg, f"Download failed!❌\n\n```{e}```", disable_web_page_preview=True)
         return
 
     if not filename:
         filename = quote_plus(url)
 
-    with tempfile.TemporaryDirectory(prefix="ytdl-", dir=TMPFILE_PATH) as f:
-        filepath = f"{f}/{filename}"
-        # consume the req.content
-        downloaded = 0
-        for chunk in req.iter_content(1024 * 1024):
-            text = tqdm_progress("Downloading...", length, downloaded)
-            edit_text(bot_msg, text)
-            with open(filepath, "ab") as fp:
-                fp.write(chunk)
-            downloaded += len(chunk)
+    # small files are done in a few seconds anyway, only stream the big ones
+    if DIRECT_STREAMING and length > 10 * 1024 * 1024:
+        client.send_chat_action(chat_id, enums.ChatAction.UPLOAD_DOCUMENT)
+        try:
+            # download and upload overlap, so this is all counted as upload
+            with span("upload", bytes=length):
+                stream_upload(client, bot_msg, req, length, filename)
+            TRANSFER_BYTES.labels("download").inc(length)
+            TRANSFER_BYTES.labels("upload").inc(length)
+            flush_text(bot_msg, "Download success!✅")
+            return
+        except Exception:
+            logging.error("Streaming failed for %s, downloading to disk instead: %s", url, traceback.format_exc())
+            req = requests.get(url, headers=headers, stream=True)
+
+    with contextlib.ExitStack() as stack:
+        with span("download") as tags:
+            ranged = DIRECT_CONNECTIONS > 1 and length and req.headers.get("accept-ranges") == "bytes"
+            if ranged and accepts_ranges(url, headers):
+                req.close()
+                # fixed directory, so the same user sending the same link again resumes the download
+                digest = hashlib.sha1(f"{chat_id}-{url}".encode()).hexdigest()[:16]
+                tempdir = pathlib.Path(TMPFILE_PATH or tempfile.gettempdir(), f"ytdl-direct-{digest}")
+                tempdir.mkdir(exist_ok=True)
+                if not stack.enter_context(directory_lock(tempdir)):
+                    # the same link is still downloading for this user, don't write into the same files
+                    tempdir = pathlib.Path(tempfile.mkdtemp(prefix="ytdl-direct-", dir=TMPFILE_PATH))
+                filepath = tempdir.joinpath(filename).as_posix()
+                ranged_download(url, headers, length, filepath, bot_msg)
+            else:
+                tempdir = pathlib.Path(tempfile.mkdtemp(prefix="ytdl-", dir=TMPFILE_PATH))
+                filepath = tempdir.joinpath(filename).as_posix()
+                downloaded = 0
+                try:
+                    with open(filepath, "wb") as fp:
+                        for chunk in req.iter_content(1024 * 1024):
+                            edit_text(bot_msg, functools.partial(tqdm_progress, "Downloading...", length, downloaded))
+                            fp.write(chunk)
+                            downloaded += len(chunk)
+                except Exception:
+                    shutil.rmtree(tempdir, ignore_errors=True)
+                    raise
+            tags["bytes"] = st_size = os.stat(filepath).st_size
         logging.info("Downloaded file %s", filename)
-        st_size = os.stat(filepath).st_size
+        TRANSFER_BYTES.labels("download").inc(st_size)
 
-        client.send_chat_action(chat_id, enums.ChatAction.UPLOAD_DOCUMENT)
-        client.send_document(
-            bot_msg.chat.id,
-            filepath,
-            caption=f"filesize: {sizeof_fmt(st_size)}",
-            progress=upload_hook,
-            progress_args=(bot_msg,),
-        )
-        bot_msg.edit_text("Download success!✅")
+        try:
+            client.send_chat_action(chat_id, enums.ChatAction.UPLOAD_DOCUMENT)
+            with span("upload", bytes=st_size):
+                client.send_document(
+                    bot_msg.chat.id,
+                    filepath,
+                    caption=f"filesize: {sizeof_fmt(st_size)}",
+                    progress=upload_hook,
+                    progress_args=(bot_msg,),
+                )
+            TRANSFER_BYTES.labels("upload").inc(st_size)
+            flush_text(bot_msg, "Download success!✅")
+        finally:
+            shutil.rmtree(tempdir, ignore_errors=True)
 
 
+@TASKS_IN_FLIGHT.labels(WORKER_NAME, "audio").track_inprogress()
+@traced("audio")
 def normal_audio(client: Client, bot_msg: typing.Union[types.Message, typing.Coroutine]):
     chat_id = bot_msg.chat.id
     # fn = getattr(bot_msg.video, "file_name", None) or getattr(bot_msg.document, "file_name", None)
@@ -266,20 +436,25 @@ def normal_audio(client: Client, bot_msg: typing.Union[types.Message, typing.Cor
         client.send_chat_action(chat_id, enums.ChatAction.RECORD_AUDIO)
         # just try to download the audio using yt-dlp
         filepath = ytdl_download(orig_url, tmp, status_msg, hijack="bestaudio[ext=m4a]")
-        status_msg.edit_text("Sending audio now...")
+        flush_text(status_msg, "Sending audio now...")
         client.send_chat_action(chat_id, enums.ChatAction.UPLOAD_AUDIO)
         for f in filepath:
-            client.send_audio(chat_id, f)
-        status_msg.edit_text("✅ Conversion complete.")
+            with span("upload", bytes=f.stat().st_size):
+                client.send_audio(chat_id, f)
+            TRANSFER_BYTES.labels("upload").inc(f.stat().st_size)
+        flush_text(status_msg, "✅ Conversion complete.")
         Redis().update_metrics("audio_success")
 
 
-def ytdl_normal_download(client: Client, bot_msg: types.Message | typing.Any, url: str):
+@TASKS_IN_FLIGHT.labels(WORKER_NAME, "ytdl").track_inprogress()
+@traced("ytdl")
+def ytdl_normal_download(client: Client, bot_msg: types.Message | typing.Any, url: str, unique: str = None):
     """
     This function is called by celery task or directly by bot
     :param client: bot client, either from main or bot(celery)
     :param bot_msg: bot message
     :param url: url to download
+    :param unique: send cache key of the flight, the settings of a new user can change before the upload
     """
     chat_id = bot_msg.chat.id
     temp_dir = tempfile.TemporaryDirectory(prefix="ytdl-", dir=TMPFILE_PATH)
@@ -287,20 +462,25 @@ def ytdl_normal_download(client: Client, bot_msg: types.Message | typing.Any, ur
     video_paths = ytdl_download(url, temp_dir.name, bot_msg)
     logging.info("Download complete.")
     client.send_chat_action(chat_id, enums.ChatAction.UPLOAD_DOCUMENT)
-    bot_msg.edit_text("Download complete. Sending now...")
+    flush_text(bot_msg, "Download complete. Sending now...")
+    size = sum(path.stat().st_size for path in video_paths)
     try:
-        upload_processor(client, bot_msg, url, video_paths)
+        with span("upload", bytes=size):
+            upload_processor(client, bot_msg, url, video_paths, unique)
     except pyrogram.errors.Flood as e:
         logging.critical("FloodWait from Telegram: %s", e)
+        FLOOD_WAITS.labels("upload").inc()
         client.send_message(
             chat_id,
             f"I'm being rate limited by Telegram. Your video will come after {e} seconds. Please wait patiently.",
         )
         client.send_message(OWNER, f"CRITICAL INFO: {e}")
         time.sleep(e.value)
-        upload_processor(client, bot_msg, url, video_paths)
+        with span("upload", bytes=size):
+            upload_processor(client, bot_msg, url, video_paths, unique)
+    TRANSFER_BYTES.labels("upload").inc(size)
 
-    bot_msg.edit_text("Download success!✅")
+    flush_text(bot_msg, "Download success!✅")
 
     # setup rclone environment var to back up the downloaded file
     if RCLONE_PATH:
@@ -313,7 +493,12 @@ def ytdl_normal_download(client: Client, bot_msg: types.Message | typing.Any, ur
 def generate_input_media(file_paths: list, cap: str) -> list:
     input_media = []
     for path in file_paths:
-        mime = filetype.guess_mime(path)
+        if isinstance(path, str):
+            # file id from the send cache
+            file_type = FileId.decode(path).file_type
+            mime = {FileType.VIDEO: "video", FileType.PHOTO: "image", FileType.AUDIO: "audio"}.get(file_type, "")
+        else:
+            mime = guess_mime(path) or ""
         if "video" in mime:
             input_media.append(pyrogram.types.InputMediaVideo(media=path))
         elif "image" in mime:
@@ -327,7 +512,89 @@ def generate_input_media(file_paths: list, cap: str) -> list:
     return input_media
 
 
-def upload_processor(client: Client, bot_msg: types.Message, url: str, vp_or_fid: str | list):
+def preupload_media(client: Client, chat_id: int, media: types.InputMedia, progress) -> types.InputMedia:
+    # upload one group member on its own, send_media_group will only get the file id
+    path = media.media
+    file = client.save_file(path, progress=progress)
+    if isinstance(media, types.InputMediaPhoto):
+        uploaded = raw.types.InputMediaUploadedPhoto(file=file)
+    elif isinstance(media, types.InputMediaVideo):
+        attributes = [raw.types.DocumentAttributeVideo(supports_streaming=True, duration=0, w=0, h=0)]
+        uploaded = raw.types.InputMediaUploadedDocument(
+            file=file,
+            mime_type=guess_mime(path) or "video/mp4",
+            attributes=[*attributes, raw.types.DocumentAttributeFilename(file_name=path.name)],
+        )
+    else:
+        attributes = [raw.types.DocumentAttributeAudio(duration=0)] if isinstance(media, types.InputMediaAudio) else []
+        uploaded = raw.types.InputMediaUploadedDocument(
+            file=file,
+            mime_type=guess_mime(path) or "application/zip",
+            attributes=[*attributes, raw.types.DocumentAttributeFilename(file_name=path.name)],
+        )
+    res = client.invoke(raw.functions.messages.UploadMedia(peer=client.resolve_peer(chat_id), media=uploaded))
+
+    if isinstance(media, types.InputMediaPhoto):
+        file_id = FileId(
+            file_type=FileType.PHOTO,
+            dc_id=res.photo.dc_id,
+            media_id=res.photo.id,
+            access_hash=res.photo.access_hash,
+            file_reference=res.photo.file_reference,
+            thumbnail_source=ThumbnailSource.THUMBNAIL,
+            thumbnail_file_type=FileType.PHOTO,
+            thumbnail_size=res.photo.sizes[-1].type,
+            volume_id=0,
+            local_id=0,
+        )
+    else:
+        file_type = {
+            types.InputMediaVideo: FileType.VIDEO,
+            types.InputMediaAudio: FileType.AUDIO,
+        }.get(type(media), FileType.DOCUMENT)
+        file_id = FileId(
+            file_type=file_type,
+            dc_id=res.document.dc_id,
+            media_id=res.document.id,
+            access_hash=res.document.access_hash,
+            file_reference=res.document.file_reference,
+        )
+    media.media = file_id.encode()
+    return media
+
+
+def send_media_group(client: Client, bot_msg: types.Message, file_paths: list, cap: str) -> list:
+    # upload all files at once, as many as the client could transmit, then send them in groups of 10
+    chat_id = bot_msg.chat.id
+    input_media = generate_input_media(file_paths, cap)
+    # cached file ids don't need an upload
+    uploads = [(index, media) for index, media in enumerate(input_media) if isinstance(media.media, pathlib.Path)]
+    total = sum(os.stat(media.media).st_size for _, media in uploads)
+    # all keys exist up front, the upload threads only replace values while the sum iterates over them
+    progress = dict.fromkeys((index for index, _ in uploads), 0)
+
+    def hook(index, current, _):
+        progress[index] = current
+        upload_hook(sum(progress.values()), total, bot_msg)
+
+    with concurrent.futures.ThreadPoolExecutor(client.max_concurrent_transmissions) as executor:
+        futures = [
+            executor.submit(preupload_media, client, chat_id, media, functools.partial(hook, index))
+            for index, media in uploads
+        ]
+        for future in futures:
+            future.result()
+
+    # balanced groups of 2 to 10, telegram rejects a group of one, e.g. the last one of 11 files
+    groups = -(-len(input_media) // 10)
+    bounds = [len(input_media) * i // groups for i in range(groups + 1)]
+    res_msg = []
+    for start, end in zip(bounds, bounds[1:]):
+        res_msg.extend(client.send_media_group(chat_id, input_media[start:end]))
+    return res_msg
+
+
+def upload_processor(client: Client, bot_msg: types.Message, url: str, vp_or_fid: str | list, unique: str = None):
     redis = Redis()
     # raise pyrogram.errors.exceptions.FloodWait(13)
     # if is str, it's a file id; else it's a list of paths
@@ -335,10 +602,15 @@ def upload_processor(client: Client, bot_msg: types.Message, url: str, vp_or_fid
     chat_id = bot_msg.chat.id
     markup = gen_video_markup()
     if isinstance(vp_or_fid, list) and len(vp_or_fid) > 1:
-        # just generate the first for simplicity, send as media group(2-20)
+        # just generate the first for simplicity, send as media groups of up to 10
         cap, meta = gen_cap(bot_msg, url, vp_or_fid[0])
-        res_msg: list["types.Message"] | Any = client.send_media_group(chat_id, generate_input_media(vp_or_fid, cap))
-        # TODO no cache for now
+        res_msg: list["types.Message"] | Any = send_media_group(client, bot_msg, vp_or_fid, cap)
+        unique = unique or get_unique_clink(url, bot_msg.chat.id)
+        file_ids = [
+            getattr(m.document or m.video or m.audio or m.animation or m.photo, "file_id", None) for m in res_msg
+        ]
+        if all(file_ids):
+            redis.add_send_cache(unique, file_ids, channel.get_canonical_link(url))
         return res_msg[0]
     elif isinstance(vp_or_fid, list) and len(vp_or_fid) == 1:
         # normal download, just contains one file in video_paths
@@ -425,9 +697,9 @@ def upload_processor(client: Client, bot_msg: types.Message, url: str, vp_or_fid
                     progress_args=(bot_msg,),
                 )
 
-    unique = get_unique_clink(url, bot_msg.chat.id)
+    unique = unique or get_unique_clink(url, bot_msg.chat.id)
     obj = res_msg.document or res_msg.video or res_msg.audio or res_msg.animation or res_msg.photo
-    redis.add_send_cache(unique, getattr(obj, "file_id", None))
+    redis.add_send_cache(unique, getattr(obj, "file_id", None), channel.get_canonical_link(url))
     redis.update_metrics("video_success")
     if ARCHIVE_ID and isinstance(vp_or_fid, pathlib.Path):
         client.forward_messages(bot_msg.chat.id, ARCHIVE_ID, res_msg.id)
@@ -444,7 +716,8 @@ def gen_cap(bm, url, video_path):
         user_info = ""
 
     if isinstance(video_path, pathlib.Path):
-        meta = get_metadata(video_path)
+        with span("metadata"):
+            meta = get_metadata(video_path, download_thumbnail(url, channel.get_canonical_link(url)))
         file_name = video_path.name
         file_size = sizeof_fmt(os.stat(video_path).st_size)
     else:
@@ -456,8 +729,8 @@ def gen_cap(bm, url, video_path):
             duration=getattr(video_path, "duration", 0),
             thumb=getattr(video_path, "thumb", None),
         )
-    free = payment.get_free_token(chat_id)
-    pay = payment.get_pay_token(chat_id)
+    profile = payment.get_profile(chat_id)
+    free, pay = profile["free"], profile["pay"]
     if ENABLE_VIP:
         remain = f"Download token count: free {free}, pay {pay}"
     else:
@@ -517,22 +790,33 @@ def purge_tasks():
     return f"purged {count} tasks."
 
 
-def run_celery():
+def run_celery(queue: str):
+    # one worker per queue, so long transcodes never take the download slots.
+    # a worker keeps its queue selection on its app, so each of them needs an app of its own, tasks are shared
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
-    worker_name = os.getenv("WORKER_NAME", "")
-    argv = ["-A", "tasks", "worker", "--loglevel=info", "--pool=threads", f"--concurrency={WORKERS}", "-n", worker_name]
-    app.worker_main(argv)
+    worker = create_celery().Worker(
+        hostname=f"{queue}@{WORKER_NAME}",
+        queues=[queue],
+        pool_cls="threads",
+        concurrency=QUEUE_CONCURRENCY[queue],
+        loglevel="INFO",
+    )
+    worker.start()
 
 
 if __name__ == "__main__":
     print("Bootstrapping Celery worker now.....")
     time.sleep(5)
-    threading.Thread(target=run_celery, daemon=True).start()
+    for queue in CELERY_QUEUES:
+        threading.Thread(target=run_celery, args=(queue,), daemon=True).start()
 
     scheduler = BackgroundScheduler(timezone="Europe/London")
     scheduler.add_job(auto_restart, "interval", seconds=900)
+    scheduler.add_job(clean_tempfile, "interval", seconds=600)
+    scheduler.add_job(clean_thumbnail, "interval", seconds=3600)
     scheduler.start()
 
+    keep_alive()
     idle()
     bot.stop()
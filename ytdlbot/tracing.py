@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# ytdlbot - tracing.py
+# per task stage timing, one json line per task in a local trace file.
+# stage durations also go to redis, so /ping shows the percentiles of every worker
+
+import contextlib
+import contextvars
+import functools
+import json
+import logging
+import os
+import pathlib
+import tempfile
+import threading
+import time
+
+from config import TMPFILE_PATH, TRACE_FILE
+from keep_alive import STAGE_SECONDS, WORKER_NAME
+
+TRACE_PATH = pathlib.Path(TRACE_FILE or os.path.join(TMPFILE_PATH or tempfile.gettempdir(), "ytdl-trace.jsonl"))
+# the file is moved to .1 once it's this big, so there are at most two of them
+TRACE_MAX_SIZE = 16 * 1024 * 1024
+
+current_trace = contextvars.ContextVar("current_trace", default=None)
+write_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def task_trace(kind: str, **tags):
+    trace = {"task": kind, "worker": WORKER_NAME, "start": time.time(), **tags, "spans": []}
+    token = current_trace.set(trace)
+    try:
+        yield trace
+    except Exception as e:
+        trace["error"] = type(e).__name__
+        raise
+    finally:
+        current_trace.reset(token)
+        trace["seconds"] = round(time.time() - trace["start"], 3)
+        write_trace(trace)
+        push_trace(trace)
+
+
+def traced(kind: str):
+    # for task functions called as func(client, bot_msg, ...)
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(client, bot_msg, *args, **kwargs):
+            with task_trace(kind, chat_id=bot_msg.chat.id):
+                return func(client, bot_msg, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@contextlib.contextmanager
+def span(stage: str, **tags):
+    # the yielded dict takes tags that are only known at the end, like bytes
+    start = time.time()
+    try:
+        yield tags
+    except Exception as e:
+        tags["error"] = type(e).__name__
+        raise
+    finally:
+        elapsed = time.time() - start
+        STAGE_SECONDS.labels(stage).observe(elapsed)
+        if (trace := current_trace.get()) is not None:
+            trace["spans"].append({"stage": stage, "seconds": round(elapsed, 3), **tags})
+
+
+def add_tags(**tags):
+    if (trace := current_trace.get()) is not None:
+        trace.update(tags)
+
+
+def write_trace(trace: dict):
+    line = json.dumps(trace, ensure_ascii=False, default=str)
+    try:
+        with write_lock:
+            if TRACE_PATH.exists() and TRACE_PATH.stat().st_size > TRACE_MAX_SIZE:
+                TRACE_PATH.replace(TRACE_PATH.with_suffix(".jsonl.1"))
+            with open(TRACE_PATH, "a") as f:
+                f.write(line + "\n")
+    except OSError as e:
+        logging.error("Failed to write trace: %s", e)
+
+
+def push_trace(trace: dict):
+    # database imports this module
+    from database import Redis
+
+    try:
+        Redis().add_stage_durations(trace)
+    except Exception as e:
+        logging.error("Failed to push stage durations: %s", e)
+
+
+def read_traces(since: float) -> list:
+    traces = []
+    for path in [TRACE_PATH.with_suffix(".jsonl.1"), TRACE_PATH]:
+        with contextlib.suppress(FileNotFoundError):
+            with open(path) as f:
+                for line in f:
+                    with contextlib.suppress(ValueError):
+                        trace = json.loads(line)
+                        if trace["start"] >= since:
+                            traces.append(trace)
+    return traces
+
+
+def percentile(values: list, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, round(q * (len(values) - 1)))]
@@ -1,6 +1,8 @@
 
 
 import contextlib
+import fcntl
+import functools
 import inspect as pyinspect
 import logging
 import os
@@ -13,12 +15,15 @@ import uuid
 
 import coloredlogs
 import ffmpeg
+import filetype
 import psutil
 
 from config import TMPFILE_PATH
 from flower_tasks import app
 
 inspect = app.control.inspect()
+# site thumbnails, shared by every download of the same link
+THUMBNAIL_PATH = pathlib.Path(TMPFILE_PATH or tempfile.gettempdir(), "thumbnail-cache")
 
 
 def apply_log_formatter():
@@ -48,7 +53,7 @@ def is_youtube(url: str):
 
 
 def adjust_formats(user_id: int, url: str, formats: list, hijack=None):
-    from database import MySQL
+    from limit import Payment
 
     # high: best quality 1080P, 2K, 4K, 8K
     # medium: 720P
@@ -58,7 +63,7 @@ def adjust_formats(user_id: int, url: str, formats: list, hijack=None):
         return
 
     mapping = {"high": [], "medium": [720], "low": [480]}
-    settings = MySQL().get_user_settings(user_id)
+    settings = Payment().get_user_settings(user_id)
     if settings and is_youtube(url):
         for m in mapping.get(settings[1], []):
             formats.insert(0, f"bestvideo[ext=mp4][height={m}]+bestaudio[ext=m4a]")
@@ -68,16 +73,55 @@ def adjust_formats(user_id: int, url: str, formats: list, hijack=None):
         formats.insert(0, "bestaudio[ext=m4a]")
 
 
-def get_metadata(video_path):
+@functools.lru_cache(maxsize=256)
+def _probe(path: str, size: int, mtime: int) -> tuple:
+    # OSError: ffprobe is missing or the file can't be read, the mime type is still sniffed on its own
+    try:
+        return ffmpeg.probe(path), None
+    except (ffmpeg.Error, OSError) as e:
+        return None, e
+
+
+@functools.lru_cache(maxsize=256)
+def _mime(path: str, size: int, mtime: int) -> str | None:
+    try:
+        return filetype.guess_mime(path)
+    except OSError as e:
+        logging.warning("Failed to guess mime type of %s: %s", path, e)
+
+
+def _file_key(path) -> tuple:
+    # one ffprobe process and one mime sniff per file, shared by conversion, metadata and upload.
+    # size and mtime are part of the key, so a file rewritten in place is probed again
+    stat = os.stat(path)
+    return os.fspath(path), stat.st_size, stat.st_mtime_ns
+
+
+def probe_media(path) -> dict:
+    probe, error = _probe(*_file_key(path))
+    if error:
+        raise error
+    return probe
+
+
+def guess_mime(path) -> str | None:
+    return _mime(*_file_key(path))
+
+
+def get_metadata(video_path, thumb=None):
     width, height, duration = 1280, 720, 0
     try:
-        video_streams = ffmpeg.probe(video_path, select_streams="v")
-        for item in video_streams.get("streams", []):
-            height = item["height"]
-            width = item["width"]
-        duration = int(float(video_streams["format"]["duration"]))
+        probe = probe_media(video_path)
+        for item in probe.get("streams", []):
+            if item["codec_type"] == "video":
+                height = item["height"]
+                width = item["width"]
+        duration = int(float(probe["format"]["duration"]))
     except Exception as e:
         logging.error(e)
+    if thumb:
+        # site thumbnail is already there, no need to decode a frame
+        return dict(height=height, width=width, duration=duration, thumb=thumb)
     try:
         thumb = pathlib.Path(video_path).parent.joinpath(f"{uuid.uuid4().hex}-thunmnail.png").as_posix()
         ffmpeg.input(video_path, ss=duration / 2).filter("scale", width, -1).output(thumb, vframes=1).run()
@@ -182,6 +226,8 @@ class Detector:
 
 
 def auto_restart():
+    from database import metrics
+
     log_path = "/var/log/ytdl.log"
     if not os.path.exists(log_path):
         return
@@ -194,15 +240,58 @@ def auto_restart():
         if method():
             logging.critical("%s bye bye world!☠️", method)
             for item in pathlib.Path(TMPFILE_PATH or tempfile.gettempdir()).glob("ytdl-*"):
-                shutil.rmtree(item, ignore_errors=True)
+                # partial direct downloads are resumed after the restart, clean_tempfile drops them once stale
+                if not item.name.startswith("ytdl-direct-"):
+                    shutil.rmtree(item, ignore_errors=True)
             time.sleep(5)
+            # SIGKILL skips atexit, the buffered counters would be lost
+            metrics.flush()
             psutil.Process().kill()
 
 
+@contextlib.contextmanager
+def directory_lock(path: pathlib.Path):
+    # flock on the directory itself, yields False if another thread or process holds it.
+    # a directory that was removed and created again while waiting counts as held, it belongs to someone else now
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except FileNotFoundError:
+        yield False
+        return
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        yield False
+        return
+    try:
+        yield os.path.exists(path) and os.stat(path).st_ino == os.fstat(fd).st_ino
+    finally:
+        os.close(fd)
+
+
+def last_modified(path: pathlib.Path) -> float:
+    # a directory's own mtime doesn't change while a file in it is being written
+    mtime = path.stat().st_mtime
+    for root, _, files in os.walk(path):
+        for name in files:
+            with contextlib.suppress(FileNotFoundError):
+                mtime = max(mtime, os.stat(os.path.join(root, name)).st_mtime)
+    return mtime
+
+
 def clean_tempfile():
     for item in pathlib.Path(TMPFILE_PATH or tempfile.gettempdir()).glob("ytdl-*"):
-        if time.time() - item.stat().st_ctime > 3600:
-            shutil.rmtree(item, ignore_errors=True)
+        with contextlib.suppress(FileNotFoundError), directory_lock(item) as unused:
+            # resumable direct downloads are kept for an hour after they stopped making progress
+            if unused and time.time() - last_modified(item) > 3600:
+                shutil.rmtree(item, ignore_errors=True)
+
+
+def clean_thumbnail():
+    for item in THUMBNAIL_PATH.glob("*"):
+        if time.time() - item.stat().st_mtime > 24 * 3600:
+            item.unlink(missing_ok=True)
 
 
 if __name__ == "__main__":
@@ -1,6 +1,5 @@
 
 
-import contextlib
 import json
 import logging
 import os
@@ -11,11 +10,10 @@ import time
 import traceback
 from io import BytesIO
 from typing import Any
-from keep_alive import keep_alive 
+from keep_alive import FLOOD_WAITS, keep_alive
 
 import pyrogram.errors
 import qrcode
-import yt_dlp
 from apscheduler.schedulers.background import BackgroundScheduler
 from pyrogram import Client, enums, filters, types
 from pyrogram.errors.exceptions.bad_request_400 import UserNotParticipant
@@ -52,7 +50,7 @@ from tasks import (
     purge_tasks,
     ytdl_download_entrance,
 )
-from utils import auto_restart, clean_tempfile, customize_logger, get_revision
+from utils import auto_restart, clean_tempfile, clean_thumbnail, customize_logger, get_revision
 
 logging.info("Authorized users are %s", AUTHORIZED_USER)
 customize_logger(["pyrogram.client", "pyrogram.session.session", "pyrogram.connection.connection"])
@@ -242,7 +240,7 @@ def settings_handler(client: Client, message: types.Message):
     chat_id = message.chat.id
     payment = Payment()
     client.send_chat_action(chat_id, enums.ChatAction.TYPING)
-    data = MySQL().get_user_settings(chat_id)
+    data = payment.get_user_settings(chat_id)
     set_mode = data[-1]
     text = {"Local": "Celery", "Celery": "Local"}.get(set_mode, "Local")
     mode_text = f"Download mode: **{set_mode}**"
@@ -388,20 +386,12 @@ def generate_invoice(amount: int, title: str, description: str, payload: str):
 def link_checker(url: str) -> str:
     if url.startswith("https://www.instagram.com"):
         return ""
-    ytdl = yt_dlp.YoutubeDL()
-
-    if not PLAYLIST_SUPPORT and (
-        re.findall(r"^https://www\.youtube\.com/channel/", Channel.extract_canonical_link(url)) or "list" in url
-    ):
+    if not PLAYLIST_SUPPORT and (channel.get_canonical_link(url).startswith("YoutubeTab:") or "list" in url):
         return "Playlist or channel links are disabled."
 
     if not M3U8_SUPPORT and (re.findall(r"m3u8|\.m3u8|\.m3u$", url.lower())):
         return "m3u8 links are disabled."
 
-    with contextlib.suppress(yt_dlp.utils.DownloadError):
-        if ytdl.extract_info(url, download=False).get("live_status") == "is_live":
-            return "Live stream links are disabled. Please download it after the stream ends."
-
 
 def search_ytb(kw: str):
     videos_search = VideosSearch(kw, limit=10)
@@ -448,13 +438,11 @@ def download_handler(client: Client, message: types.Message):
 
         # old user is not limited by token
         if ENABLE_VIP and not payment.check_old_user(chat_id):
-            free, pay, reset = payment.get_token(chat_id)
-            if free + pay <= 0:
+            if not payment.use_token(chat_id):
+                _, _, reset = payment.get_token(chat_id)
                 message.reply_text(f"You don't have enough token. Please wait until {reset} or /buy .", quote=True)
                 redis.update_metrics("reject_token")
                 return
-            else:
-                payment.use_token(chat_id)
 
         redis.update_metrics("video_request")
 
@@ -463,6 +451,7 @@ def download_handler(client: Client, message: types.Message):
             # raise pyrogram.errors.exceptions.FloodWait(10)
             bot_msg: types.Message | Any = message.reply_text(text, quote=True)
         except pyrogram.errors.Flood as e:
+            FLOOD_WAITS.labels("reply").inc()
             f = BytesIO()
             f.write(str(e).encode())
             f.write(b"Your job will be done soon. Just wait! Don't rush.")
@@ -484,7 +473,7 @@ def send_method_callback(client: Client, callback_query: types.CallbackQuery):
     chat_id = callback_query.message.chat.id
     data = callback_query.data
     logging.info("Setting %s file type to %s", chat_id, data)
-    MySQL().set_user_settings(chat_id, "method", data)
+    Payment().set_user_settings(chat_id, "method", data)
     callback_query.answer(f"Your send type was set to {callback_query.data}")
 
 
@@ -493,7 +482,7 @@ def download_resolution_callback(client: Client, callback_query: types.CallbackQ
     chat_id = callback_query.message.chat.id
     data = callback_query.data
     logging.info("Setting %s file type to %s", chat_id, data)
-    MySQL().set_user_settings(chat_id, "resolution", data)
+    Payment().set_user_settings(chat_id, "resolution", data)
     callback_query.answer(f"Your default download quality was set to {callback_query.data}")
 
 
@@ -513,7 +502,7 @@ def audio_callback(client: Client, callback_query: types.CallbackQuery):
 @app.on_callback_query(filters.regex(r"Local|Celery"))
 def owner_local_callback(client: Client, callback_query: types.CallbackQuery):
     chat_id = callback_query.message.chat.id
-    MySQL().set_user_settings(chat_id, "mode", callback_query.data)
+    Payment().set_user_settings(chat_id, "mode", callback_query.data)
     callback_query.answer(f"Download mode was changed to {callback_query.data}")
 
 
@@ -567,8 +556,10 @@ if __name__ == "__main__":
     scheduler = BackgroundScheduler(timezone="Europe/London")
     scheduler.add_job(auto_restart, "interval", seconds=600)
     scheduler.add_job(clean_tempfile, "interval", seconds=120)
+    scheduler.add_job(clean_thumbnail, "interval", seconds=3600)
     if not IS_BACKUP_BOT:
         scheduler.add_job(Redis().reset_today, "cron", hour=0, minute=0)
+        scheduler.add_job(Redis().rekey_send_cache, args=[Channel.match_extractor])
         scheduler.add_job(InfluxDB().collect_data, "interval", seconds=120)
         scheduler.add_job(TronTrx().check_payment, "interval", seconds=60, max_instances=1)
         #  default quota allocation of 10,000 units per day